@@ -1,7 +1,24 @@
 #Goof create
 import sys
+import os
 import gaia
-import base64
+import csv
+import errno
+import gzip
+import json
+import time
+import shutil
+import shlex
+import pipes
+import socket
+import threading
+import subprocess
+import SocketServer
+import StringIO
+import tempfile
+
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 from marionette_driver import By
 from marionette_driver import Wait
@@ -9,95 +26,1008 @@ from marionette import Marionette
 #from marionette_driver.marionette import Marionette
 
 SPLIT_SYM = "="
+# commands accepting several arguments
+MULTI_ARG_COMMANDS = ("getsettings", "setsettings", "bench-launch", "push", "pull", "syncdir")
+# commands taking only options
+OPTION_COMMANDS = ("soak", "bench-host")
+# options given without a value, "--profile=trace.json" still sets one
+FLAG_OPTIONS = ("profile", "json", "quiet")
+# exit codes: done, ran without the expected result, bad parameters, error (device, script, timeout)
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_ERROR = 3
+# marionette port on the device, "fleet" forwards a free local port to it
+MARIONETTE_PORT = 2828
+# capture format picked from the file extension when --format is not given
+CAPTURE_FORMATS = {'.jpg': 'jpeg', '.jpeg': 'jpeg', '.raw': 'raw', '.rgba': 'raw'}
 
-def main(argv):
-
-    if len(argv) == 3:
-        cmd = argv[1]
-        name = argv[2]
-    else :
-        print "parameters format not correct!"
-        print """Synopsis:   
-            %s command[run/capture/press/getpref/getsettings/setsettings] [app_name/file_name/key_name/settings_name]
+USAGE = """Synopsis:
+            %(prog)s command[run/capture/press/getpref/getsettings/setsettings/batch/fleet/serve/stop] [app_name/file_name/key_name/settings_name/socket]
 example:
-            %s run camera
-            %s capture screenshot.png
-            %s press home
-            %s getprop/setprop [key%s(value)]
-            %s getsetting/setsetting [key%s(value)]
-                    """%(argv[0],argv[0],argv[0],argv[0],argv[0],SPLIT_SYM,argv[0],SPLIT_SYM)
-        exit()
-
-    print "open port"
-    client = Marionette('localhost', port=2828)#defined in setup.py
-    client.start_session()
-    
-    app_manager = gaia.GaiaApps(client)
-    dev_manager = gaia.GaiaDevice(client)
-    data_manager = gaia.GaiaData(client)
-	
+            %(prog)s run camera
+            %(prog)s capture screenshot.png
+            %(prog)s capture shot.jpg --quality 0.7 --scale 0.5 --region 0,0,240,160
+                                       format from the extension (png/jpg/raw) or --format
+            %(prog)s record out_dir --fps 10 --duration 5
+                                       frames as jpeg unless --format, unchanged frames skipped
+            %(prog)s bench-launch camera clock --iterations 10 [--output csv]
+                                       cold/warm/displayed launch times in ms
+            %(prog)s perf camera --duration 10 [--bucket 1]
+                                       reflow/jank/memory/fps from the developer HUD
+            %(prog)s bench-host [--iterations 20] [--latency 0] [--only session,run] [--output csv]
+                       [--baseline bench.json] [--tolerance 0.25]
+                                       host side cost of commands against a local fake marionette,
+                                       no device needed; fails when slower than the baseline
+            %(prog)s soak --apps camera,clock,music --cycles 200 [--threshold 100] [--samples out.json]
+                                       memory trend over launch/switch/kill cycles
+            %(prog)s importcontacts phonebook.vcf|phonebook.csv [--chunk 200] [--concurrency 8]
+            %(prog)s push song.mp3 music:fixtures/song.mp3
+            %(prog)s pull pictures:DCIM/100MZLLA/IMG_0001.jpg img.jpg
+            %(prog)s syncdir ./gallery pictures:fixtures   skips files identical on the device
+            %(prog)s press home
+            %(prog)s keys "ArrowDown*5 Enter wait:#options sleep:500 SoftLeft@300" [--delay 100]
+                                       whole sequence in one script, KEY*count@ms_after
+            %(prog)s keys @macro.txt
+            %(prog)s a11y "button, [role=button]" [--timeout 5]
+                                       name/role/states of the matches in the displayed app, one round trip
+            %(prog)s recordkeys macro.txt --duration 10   keys pressed on the device
+            %(prog)s getprop/setprop [key%(sym)s(value)]
+            %(prog)s getsetting/setsetting [key%(sym)s(value)] [key%(sym)s(value)...]
+            %(prog)s snapshot state.json.gz [--prefs pref,pref] [--exclude prefix,prefix]
+                                       settings, prefs and known wifi networks
+            %(prog)s restore state.json.gz   writes only what differs
+            %(prog)s batch commands.txt   one command per line, '-' reads stdin
+            %(prog)s fleet serial1,serial2,2830 run camera
+            %(prog)s fleet serial1,serial2 batch commands.txt
+                                       same command on every device in parallel,
+                                       numbers are already forwarded local ports
+            %(prog)s serve [socket]       keep one session open, later commands reuse it
+            %(prog)s stop [socket]
+            --json                     one json line per command: result, error, timing
+            --quiet                    skip the round trips made only to print diagnostics
+            --profile                  after any command, marionette round trips per gaia method
+            --profile=trace.json       the same as a Chrome trace (chrome://tracing)
+"""
+# unix socket used by "serve"; every other command is forwarded to it when it exists
+SOCKET_PATH = os.environ.get('APP_CMD_SOCKET', '/tmp/app_cmd.sock')
+
+
+class Session(object):
+    """A started marionette session together with the gaia helpers built on it."""
+
+    def __init__(self, host='localhost', port=2828, verbose=True):
+        if verbose: print "open port"
+        # scripts run straight on the client are profiled too
+        self.client = gaia.AtomLoader.wrap(Marionette(host, port=port))#defined in setup.py
+        self.client.start_session()
+
+        self.apps = gaia.GaiaApps(self.client)
+        self.device = gaia.GaiaDevice(self.client)
+        self.data = gaia.GaiaData(self.client)
+
+    def close(self):
+        self.client.delete_session()
+
+
+class CommandFailed(Exception):
+    """The command ran but did not get the expected result."""
+
+
+class UsageError(Exception):
+    """Unknown command or bad parameters."""
+
+
+def exit_code(error):
+    """Exit code for an error string from execute_captured/send_command (None when it succeeded)."""
+    if not error:
+        return EXIT_OK
+    if error.startswith(CommandFailed.__name__):
+        return EXIT_FAILED
+    if error.startswith(UsageError.__name__):
+        return EXIT_USAGE
+    return EXIT_ERROR
+
+
+def split_options(words):
+    """Separates '--key value' and '--key=value' options from the positional words."""
+    positional = []
+    options = {}
+    words = iter(words)
+    for word in words:
+        if not word.startswith('--'):
+            positional.append(word)
+        elif '=' in word:
+            key, value = word[2:].split('=', 1)
+            options[key] = value
+        elif word[2:] in FLAG_OPTIONS:
+            options[word[2:]] = True
+        else:
+            options[word[2:]] = next(words, None)
+    return positional, options
+
+
+def command_argument(cmd, words):
+    """Returns the argument of cmd: a single word, or a list for MULTI_ARG_COMMANDS."""
+    if len(words) > 1 and cmd in MULTI_ARG_COMMANDS:
+        return words
+    if len(words) == 1:
+        return words[0]
+    raise ValueError("expected 'command argument', got %r" % " ".join([cmd] + words))
+
+
+def screenshot_options(options, default_format):
+    """Returns the takeScreenshot keyword arguments given by --format/--quality/--scale/--region."""
+    return {'format': options.get('format') or default_format,
+            'quality': float(options['quality']) if options.get('quality') else None,
+            'scale': float(options['scale']) if options.get('scale') else None,
+            'region': map(int, options['region'].split(',')) if options.get('region') else None}
+
+
+def capture(dev_manager, name, options):
+    """Saves a screenshot to name and reports how long it took and the peak memory of the process."""
+    extension = os.path.splitext(name)[1].lower()
+    stats = dev_manager.save_screenshot(name, **screenshot_options(options, CAPTURE_FORMATS.get(extension, 'png')))
+    print "captured %s, %d bytes: capture %.1f ms, write %.1f ms, process peak memory %s KB" % (
+        stats['format'], stats['bytes'], stats['capture_seconds'] * 1000,
+        stats['write_seconds'] * 1000, stats['process_peak_memory_kb'])
+    return stats
+
+
+def record(dev_manager, name, options):
+    """Records frames into the directory name, see gaia.ScreenRecorder."""
+    recorder = gaia.ScreenRecorder(dev_manager, name, **screenshot_options(options, 'jpeg'))
+    stats = recorder.record(float(options.get('fps') or 10), float(options.get('duration') or 5))
+    print "recorded %d frames in %.1f s (%.1f fps), %d unchanged frames skipped, %d written to %s" % (
+        stats['captured'], stats['seconds'], stats['fps'], stats['skipped'], stats['written'], name)
+    return stats
+
+
+def bench_launch(session, names, options):
+    """Prints min/median/p95 launch times per app as json (default) or --output csv."""
+    names = names if isinstance(names, list) else [names]
+    benchmark = gaia.LaunchBenchmark(session.client, session.device)
+    rows = benchmark.summary(benchmark.run(names, int(options.get('iterations') or 5)))
+    if options.get('output') == 'csv':
+        writer = csv.DictWriter(sys.stdout, ['app', 'phase', 'min', 'median', 'p95', 'samples'])
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        print json.dumps(rows, indent=2)
+    return rows
+
+
+def perf(session, name, options):
+    """Launches name and prints its developer HUD metrics in time buckets as json."""
+    session.apps.launch(str(name), switch_to_frame=False)
+    # apps may be served from another origin than their manifest
+    perf = gaia.GaiaPerf(session.client, session.data)
+    summary = perf.measure(session.apps.manifest_url(str(name)), float(options.get('duration') or 10),
+                           float(options.get('bucket') or 1))
+    print json.dumps(summary, indent=2)
+    return summary
+
+
+def host_benchmarks(session, server, scratch):
+    """The bench-host cases, (name, function running one sample) against a fake marionette server.
+
+    A function returning a number measured the seconds of its sample itself.
+    """
+    client = session.client
+    names = ['bench.setting.%d' % i for i in range(500)]
+    values = dict((name, 'value %d' % i) for i, name in enumerate(names))
+    png = server.device.screenshot('', ['png'])
+
+    def startup():
+        subprocess.check_call([sys.executable, '-c', 'import app_cmd'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    def atom_import():
+        # a bare client, nothing imported yet
+        fresh = Marionette('localhost', port=server.port)
+        fresh.start_session()
+        try:
+            start = time.time()
+            gaia.atoms.require(fresh, *sorted(set(name for symbol, name in gaia.atoms.ATOMS)))
+            return time.time() - start
+        finally:
+            fresh.delete_session()
+
+    def run():
+        with captured_output():
+            execute(session, "run", "camera", {'quiet': True})
+
+    return [('startup', startup),
+            ('session', lambda: Session(port=server.port, verbose=False).close()),
+            ('atom_import', atom_import),
+            ('round_trip', lambda: client.execute_script('return true;')),
+            ('displayed_app', lambda: session.apps.displayed_app),
+            ('launch', lambda: session.apps.launch('camera', switch_to_frame=False)),
+            ('run', run),
+            ('press_keys', lambda: session.device.press_keys(['ArrowDown*20'], delay=0)),
+            ('settings_read_500', lambda: session.data.get_settings(names)),
+            ('settings_write_500', lambda: session.data.set_settings(values)),
+            ('screenshot_png', lambda: session.device.save_screenshot(os.path.join(scratch, 'shot.png'))),
+            ('screenshot_raw', lambda: session.device.save_screenshot(os.path.join(scratch, 'shot.rgba'), 'raw')),
+            ('decode_png', lambda: gaia.write_data_url(os.path.join(scratch, 'decoded.png'), png))]
+
+
+def bench_host(options):
+    """Times the host side of commands against a local fake marionette server, no device needed.
+
+    Prints min/median/p95 ms per case as json (default) or --output csv.
+    --latency adds seconds to every reply, --only runs the listed cases.
+    With --baseline (an earlier json output) cases whose median grew by more
+    than --tolerance (a fraction, 0.25 by default) fail the command.
+    """
+    # only needed here, keeps it out of the startup of every other command
+    import fake_marionette
+
+    iterations = int(options.get('iterations') or 20)
+    only = options['only'].split(',') if options.get('only') else None
+    server = fake_marionette.FakeMarionetteServer(port=0, latency=float(options.get('latency') or 0)).start()
+    scratch = tempfile.mkdtemp()
+    session = Session(port=server.port, verbose=False)
+    rows = []
+    try:
+        for name, case in host_benchmarks(session, server, scratch):
+            if only and name not in only:
+                continue
+            # the first sample also pays for atom imports and caches
+            case()
+            samples = []
+            for i in range(iterations):
+                start = time.time()
+                measured = case()
+                samples.append((measured if isinstance(measured, float) else time.time() - start) * 1000)
+            rows.append({'case': name, 'min': min(samples), 'median': gaia.percentile(samples, 0.5),
+                         'p95': gaia.percentile(samples, 0.95), 'samples': len(samples)})
+    finally:
+        session.close()
+        server.stop()
+        shutil.rmtree(scratch)
+
+    if options.get('output') == 'csv':
+        writer = csv.DictWriter(sys.stdout, ['case', 'min', 'median', 'p95', 'samples'])
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        print json.dumps(rows, indent=2)
+    if options.get('baseline'):
+        with open(options['baseline']) as f:
+            baseline = dict((row['case'], row) for row in json.load(f))
+        tolerance = float(options.get('tolerance') or 0.25)
+        slower = ["%s %.2f ms, was %.2f ms" % (row['case'], row['median'], baseline[row['case']]['median'])
+                  for row in rows if row['case'] in baseline and
+                  row['median'] > baseline[row['case']]['median'] * (1 + tolerance)]
+        if slower: raise CommandFailed("slower than %s: %s" % (options['baseline'], "; ".join(slower)))
+    return rows
+
+def read_vcards(lines):
+    """Yields a mozContact dict for every BEGIN:VCARD..END:VCARD block."""
+    unfolded = []
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and unfolded:
+            unfolded[-1] += line[1:]
+        elif line:
+            unfolded.append(line)
+
+    contact = None
+    for line in unfolded:
+        key, _, value = line.partition(':')
+        params = key.upper().split(';')
+        field = params[0].split('.')[-1]
+        types = [t.lower() for p in params[1:] if p.startswith('TYPE=') or '=' not in p
+                 for t in p.split('=', 1)[-1].split(',')]
+        if field == 'BEGIN':
+            contact = {}
+        elif field == 'END' and contact is not None:
+            yield contact
+            contact = None
+        elif contact is None:
+            continue
+        elif field == 'FN':
+            contact['name'] = [value]
+        elif field == 'N':
+            parts = value.split(';') + ['', '']
+            if parts[0]: contact['familyName'] = [parts[0]]
+            if parts[1]: contact['givenName'] = [parts[1]]
+        elif field in ('TEL', 'EMAIL'):
+            key = 'tel' if field == 'TEL' else 'email'
+            contact.setdefault(key, []).append({'type': types or ['other'], 'value': value})
+        elif field == 'ORG':
+            contact['org'] = [value.split(';')[0]]
+        elif field == 'NOTE':
+            contact['note'] = [value]
+
+
+def read_csv_contacts(lines):
+    """Yields a mozContact dict per row of a csv with name/givenName/familyName/tel/email/org columns."""
+    for row in csv.DictReader(lines):
+        row = dict((k.strip().lower(), v.strip()) for k, v in row.items() if k and v and v.strip())
+        contact = {}
+        for column, field in (('name', 'name'), ('givenname', 'givenName'),
+                              ('familyname', 'familyName'), ('org', 'org')):
+            if column in row:
+                contact[field] = [row[column]]
+        if 'tel' in row:
+            contact['tel'] = [{'type': ['mobile'], 'value': row['tel']}]
+        if 'email' in row:
+            contact['email'] = [{'type': ['personal'], 'value': row['email']}]
+        if 'name' not in contact and ('givenName' in contact or 'familyName' in contact):
+            contact['name'] = [" ".join(contact.get('givenName', []) + contact.get('familyName', []))]
+        yield contact
+
+
+def import_contacts(data_manager, name, options):
+    """Inserts the contacts of a .vcf or .csv file in chunks and prints the timing."""
+    lines = open(name)
+    contacts = read_csv_contacts(lines) if name.lower().endswith('.csv') else read_vcards(lines)
+    chunk_size = int(options.get('chunk') or gaia.CONTACT_CHUNK_SIZE)
+    concurrency = int(options.get('concurrency') or gaia.CONTACT_SAVE_CONCURRENCY)
+    start = time.time()
+    result = data_manager.insert_contacts(contacts, chunk_size, concurrency)
+    elapsed = time.time() - start
+    for number, chunk in enumerate(result['chunks'], 1):
+        print "chunk %d: %d contacts, %d failed, %.1f ms" % (number, chunk['contacts'], chunk['failed'],
+                                                             chunk['seconds'] * 1000)
+    failed = len([i for i in result['ids'] if i is None])
+    print "imported %d contacts (%d failed) in %.1f s, %.0f contacts/s" % (
+        len(result['ids']) - failed, failed, elapsed, len(result['ids']) / elapsed if elapsed else 0)
+    if failed: raise CommandFailed("%d contacts not imported" % failed)
+    return {'imported': len(result['ids']), 'chunks': result['chunks'], 'seconds': elapsed}
+
+
+def transfer(data_manager, cmd, args):
+    """push local storage:path, pull storage:path local, syncdir local_dir storage:path"""
+    if cmd == "pull":
+        remote, local = args
+    else:
+        local, remote = args
+    storage_type, path = remote.split(':', 1)
+    if cmd == "push":
+        result = data_manager.push_file(local, storage_type, path)
+    elif cmd == "pull":
+        result = data_manager.pull_file(storage_type, path, local)
+    else:
+        result = data_manager.sync_dir(local, storage_type, path)
+        print "%d files pushed, %d already identical" % (len(result['pushed']), len(result['skipped']))
+    print "%s %d files, %d bytes in %d round trips, %.1f s, checksums ok" % (
+        cmd, result['files'], result['bytes'], result['round_trips'], result['seconds'])
+    return result
+
+
+def accessibility(client, selector, options):
+    """Name, role and states of every element matching selector in the current frame, in one round trip."""
+    rows = gaia.Accessibility(client).describe(
+        selector=selector, timeout=float(options.get('timeout') or gaia.ACCESSIBILITY_TIMEOUT))
+    for row in rows:
+        print "%-20s %-32s %s" % (row['role'], row['name'], ",".join(row['states']))
+    print "%d elements, %d visible, %d without accessible" % (
+        len(rows), len([r for r in rows if r['visible']]), len([r for r in rows if not r['accessible']]))
+    # element references only mean something to this session
+    return [dict((key, value) for key, value in row.items() if key != 'element') for row in rows]
+
+def read_macro(path):
+    """Key tokens of a macro file, '#' starts a comment."""
+    tokens = []
+    with open(path) as f:
+        for line in f:
+            tokens.extend(shlex.split(line, comments=True))
+    return tokens
+
+
+def keys(dev_manager, name, options):
+    """keys "ArrowDown*5 Enter SoftLeft" or keys @macro.txt"""
+    tokens = read_macro(name[1:]) if name.startswith('@') else name
+    result = dev_manager.press_keys(tokens, delay=int(options.get('delay') or gaia.KEY_DELAY),
+                                    wait_timeout=float(options.get('timeout') or 10))
+    print "%d keys in %d round trips, %.1f s" % (result['pressed'], result['round_trips'], result['seconds'])
+    return result
+
+
+def record_keys(dev_manager, name, options):
+    duration = float(options.get('duration') or 10)
+    print "recording keys for %.0f s" % duration
+    tokens = dev_manager.record_keys(duration)
+    with open(name, 'w') as f:
+        f.write("# recorded %s, replay with: app_cmd.py keys @%s\n" % (time.strftime('%Y-%m-%d %H:%M:%S'), name))
+        for token in tokens:
+            # quoted, a # key would start a comment
+            f.write(pipes.quote(token) + "\n")
+    print "%d keys written to %s" % (len(tokens), name)
+    return {'file': name, 'keys': tokens}
+
+
+def soak(session, options):
+    """Launch/switch/kill cycles over --apps, then the memory trend per series (kB)."""
+    names = options['apps'].split(',')
+    cycles = int(options.get('cycles') or 10)
+    test = gaia.SoakTest(session.client, session.device, session.data)
+
+    def progress(sample):
+        print "cycle %d/%d: system used %d kB" % (sample['cycle'], cycles, sample['used'])
+    samples = test.run(names, cycles, progress)
+    if options.get('samples'):
+        with open(options['samples'], 'w') as f:
+            json.dump(samples, f, indent=2)
+    errors = [sample for sample in samples if sample['step'] == 'error']
+    for sample in errors:
+        print "cycle %d: %s failed: %s" % (sample['cycle'], sample['app'], sample['error'])
+    rows = test.trend(samples, float(options.get('threshold') or gaia.SOAK_LEAK_KB_PER_CYCLE))
+    print "%-40s %10s %10s %10s %12s" % ("series", "first", "last", "max", "kB/cycle")
+    for row in rows:
+        print "%-40s %10d %10d %10d %12.1f%s" % (row['series'], row['first'], row['last'], row['max'],
+                                                row['slope'], "  LEAK?" if row['leak'] else "")
+    print "%d cycles, %d failed launches, %d series growing" % (
+        cycles, len(errors), len([row for row in rows if row['leak']]))
+    return {'cycles': cycles, 'trend': rows,
+            'errors': [dict((key, sample[key]) for key in ('cycle', 'app', 'error')) for sample in errors]}
+
+
+def write_snapshot(path, snapshot):
+    """Writes a snapshot as compact json with sorted keys, gzipped when path ends in .gz."""
+    data = json.dumps(snapshot, sort_keys=True, separators=(',', ':'))
+    with (gzip.open(path, 'wb') if path.endswith('.gz') else open(path, 'w')) as f:
+        f.write(data)
+    return len(data)
+
+
+def read_snapshot(path):
+    with (gzip.open(path, 'rb') if path.endswith('.gz') else open(path)) as f:
+        return json.load(f)
+
+
+def snapshot(data_manager, name, options):
+    """snapshot out.json[.gz] [--prefs pref,pref] [--exclude prefix,prefix]"""
+    prefs = options['prefs'].split(',') if options.get('prefs') else []
+    exclude = tuple(options['exclude'].split(',')) if options.get('exclude') else gaia.SNAPSHOT_EXCLUDED_SETTINGS
+    state = data_manager.snapshot(prefs, exclude)
+    size = write_snapshot(name, state)
+    print "%d settings, %d prefs, %d networks written to %s (%d bytes of json)" % (
+        len(state['settings']), len(state['prefs']), len(state['networks'] or []), name, size)
+    return {'file': name, 'settings': len(state['settings']), 'prefs': len(state['prefs']),
+            'networks': len(state['networks'] or []), 'bytes': size}
+
+
+def restore(data_manager, name, options):
+    result = data_manager.restore(read_snapshot(name))
+    for kind in ('settings', 'prefs', 'forgotten', 'added'):
+        if result[kind]: print "%s: %s" % (kind, ", ".join(result[kind]))
+    changes = sum(len(result[kind]) for kind in ('settings', 'prefs', 'forgotten', 'added'))
+    print "%d changes in %.1f ms" % (changes, result['seconds'] * 1000) if changes else "nothing changed"
+    if result['missing']:
+        raise CommandFailed("no credentials to add networks %s" % ", ".join(result['missing']))
+    return result
+
+
+def print_profile(calls, trace_path=None):
+    if trace_path:
+        with open(trace_path, 'w') as f:
+            json.dump(gaia.CallProfiler.chrome_trace(calls), f)
+        print "profile: %d round trips written to %s" % (len(calls), trace_path)
+        return
+    rows = gaia.CallProfiler.summary(calls)
+    print "%-40s %6s %10s %9s %9s %10s %10s" % ("caller", "calls", "total ms", "mean ms", "max ms", "sent", "received")
+    for row in rows:
+        print "%-40s %6d %10.1f %9.1f %9.1f %10d %10d" % (
+            row['caller'], row['calls'], row['total'], row['mean'], row['max'], row['sent'], row['received'])
+    print "%-40s %6d %10.1f" % ("total", len(calls), sum(call['duration'] for call in calls))
+
+
+def json_record(cmd, name, result=None, error=None, seconds=0.0, output=""):
+    """The --json line of a command: what it returned, its error, exit code, time and text output."""
+    return json.dumps({'command': cmd, 'argument': name, 'ok': not error, 'exit_code': exit_code(error),
+                       'result': result, 'error': error, 'seconds': seconds, 'output': output},
+                      default=repr)
+
+
+def execute(session, cmd, name, options=None):
+    """Runs one command and returns its result.
+
+    Raises CommandFailed when the command did not get the expected result
+    and UsageError for unknown commands. With --json the text output is
+    replaced by one json_record line, errors are still raised afterwards.
+    """
+    options = options or {}
+    if options.get('json'):
+        start = time.time()
+        result = error = None
+        with captured_output() as output:
+            try:
+                result = execute(session, cmd, name, dict(options, json=None))
+            except Exception as e:
+                error = "%s: %s" % (type(e).__name__, e)
+                raised = sys.exc_info()
+        print json_record(cmd, name, result, error, time.time() - start, output.getvalue())
+        if error:
+            raise raised[0], raised[1], raised[2]
+        return result
+    if options.get('profile'):
+        with gaia.profiler.recording() as calls:
+            try:
+                return execute(session, cmd, name, dict(options, profile=None))
+            finally:
+                print_profile(calls, options['profile'] if options['profile'] is not True else None)
+    quiet = options.get('quiet')
+    client = session.client
+    app_manager = session.apps
+    dev_manager = session.device
+    data_manager = session.data
+
     if(cmd == "run"):
         print 'start testing'
         dev_manager.turn_screen_on()
         #dev_manager.touch_home_button()
-        print 'current orientation:', dev_manager.screen_orientation
+        if not quiet: print 'current orientation:', dev_manager.screen_orientation
         dev_manager.change_orientation("portrait-primary");
 
         # may need to unlock screen before this command
         print 'launching application: ', str(name)
-        print app_manager.launch(str(name))
-        print app_manager.running_apps()
-        app_manager.switch_to_displayed_app()
-        print app_manager.displayed_app.frame, app_manager.displayed_app.name, "is running!"
-        
+        app = app_manager.launch(str(name))
+        print 'launched %s (%s)' % (app.name, app.origin)
+        if not quiet:
+            print 'running apps:', ', '.join(running.name for running in app_manager.running_apps())
+            app_manager.switch_to_displayed_app()
+            print app_manager.displayed_app.frame, app_manager.displayed_app.name, "is running!"
+
         ###debug,dev_manager.change_orientation("landscape-primary");
+        return {'name': app.name, 'origin': app.origin, 'src': app.src,
+                'manifestURL': app_manager.manifest_url(str(name))}
     elif(cmd == "capture"):
-        width = dev_manager.screen_width
-        print 'screen size:', width
-        png_base64 = dev_manager.takeScreenshot()
+        if not quiet:
+            width = dev_manager.screen_width
+            print 'screen size:', width
         ###png_base64 = client.screenshot(app_manager.displayed_app.frame)
         #client.switch_to_frame()
-        png_base64 = png_base64[png_base64.find(",")+1:]
-        ###print png_base64
-        ###print len(png_base64)
-        
-        png = base64.b64decode(png_base64)
-        file_object = open(name,'wb')
-        try:
-            file_object.write(png)
-        finally:
-            file_object.close()
+        return capture(dev_manager, name, options)
+    elif(cmd == "record"):
+        return record(dev_manager, name, options)
+    elif(cmd == "bench-launch"):
+        return bench_launch(session, name, options)
+    elif(cmd == "perf"):
+        return perf(session, name, options)
+    elif(cmd == "soak"):
+        return soak(session, options)
+    elif(cmd == "importcontacts"):
+        return import_contacts(data_manager, name, options)
+    elif(cmd in ("push", "pull", "syncdir")):
+        return transfer(data_manager, cmd, name)
     elif(cmd == "press"):
         dev_manager.turn_screen_on()
-        print app_manager.displayed_app.frame, app_manager.displayed_app.name, "is running!"
+        if not quiet: print app_manager.displayed_app.frame, app_manager.displayed_app.name, "is running!"
         app_manager.switch_to_displayed_app()
+        if not quiet and name in gaia.SYSTEM_KEY_EVENTS: print "send event %s" % name
         dev_manager.press_button(name);
+        return {'key': name}
+    elif(cmd == "keys"):
+        dev_manager.turn_screen_on()
+        app_manager.switch_to_displayed_app()
+        return keys(dev_manager, name, options)
+    elif(cmd == "a11y"):
+        app_manager.switch_to_displayed_app()
+        return accessibility(client, name, options)
+    elif(cmd == "recordkeys"):
+        return record_keys(dev_manager, name, options)
     elif(cmd == "getpref"):
         pref = client.get_pref(name)
         print "%s%s%s" % (name,SPLIT_SYM,pref);
+        return {name: pref}
     elif(cmd == "setpref"):
         pref, value = map(str, name.split(SPLIT_SYM))
-        if(value == "true"): value = true
-        if(value == "false"): value = false
-        if(value.isdigit()): value = int(value)
+        if(value == "true"): value = True
+        elif(value == "false"): value = False
+        elif(value.isdigit()): value = int(value)
         client.set_pref(pref, value)
         prefs = client.get_pref(pref)
-        if(value == prefs): print "%s successful change to %s" % (pref,value)
-        else: print "failed#### %s:%s" % (pref,prefs)
+        if(value != prefs): raise CommandFailed("%s:%s" % (pref,prefs))
+        print "%s successful change to %s" % (pref,value)
+        return {pref: prefs}
     elif(cmd == "getsettings"):
-        settings = data_manager.get_setting(name)
-        print "%s%s%s" % (name,SPLIT_SYM,settings);
+        names = name if isinstance(name, list) else [name]
+        settings = data_manager.get_settings(names)
+        for setting in names:
+            print "%s%s%s" % (setting,SPLIT_SYM,settings.get(setting));
+        return settings
     elif(cmd == "setsettings"):
-        setting, value = map(str, name.split(SPLIT_SYM))
-        data_manager.set_setting(setting, value)
-        settings = data_manager.get_setting(setting)
-        if(value == settings): print "%s successful change to %s" % (setting,value)
-        else: print "failed#### %s" % setting
+        pairs = name if isinstance(name, list) else [name]
+        values = dict(pair.split(SPLIT_SYM, 1) for pair in pairs)
+        # written and read back in a single round trip
+        settings = data_manager.set_settings(values)
+        failed = []
+        for setting, value in sorted(values.items()):
+            if(value == settings.get(setting)): print "%s successful change to %s" % (setting,value)
+            else: failed.append(setting)
+        if failed: raise CommandFailed(", ".join(failed))
+        return settings
+    elif(cmd == "snapshot"):
+        return snapshot(data_manager, name, options)
+    elif(cmd == "restore"):
+        return restore(data_manager, name, options)
     elif(cmd == "getallsettings"):
-        settings = data_manager.all_settings()
+        settings = data_manager.all_settings
         print "all: %s" % settings;
+        return settings
+    else:
+        raise UsageError("unknown command: %s" % cmd)
+
+
+class ThreadStdout(object):
+    """sys.stdout stand-in that lets every thread capture its own prints."""
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+
+    @property
+    def stream(self):
+        return getattr(self.local, 'stream', None) or self.stdout
+
+    # print keeps its pending-space flag on the file object, keep it per thread too
+    @property
+    def softspace(self):
+        return getattr(self.stream, 'softspace', 0)
+
+    @softspace.setter
+    def softspace(self, value):
+        self.stream.softspace = value
+
+    def write(self, data):
+        self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+
+@contextmanager
+def captured_output():
+    """Collects everything the current thread prints into the yielded StringIO."""
+    if not isinstance(sys.stdout, ThreadStdout):
+        sys.stdout = ThreadStdout(sys.stdout)
+    output = StringIO.StringIO()
+    previous, sys.stdout.local.stream = sys.stdout.stream, output
+    try:
+        yield output
+    finally:
+        sys.stdout.local.stream = previous
+
+
+def execute_captured(session, cmd, name, options=None):
+    """Runs execute() with stdout captured; returns (output, error)."""
+    error = None
+    with captured_output() as output:
+        try:
+            execute(session, cmd, name, options)
+        except Exception as e:
+            error = "%s: %s" % (type(e).__name__, e)
+    return output.getvalue(), error
+
+
+def parse_batch(lines):
+    """Yields (line_number, cmd, name, options) for every command line of a batch file.
+
+    Blank lines and lines starting with '#' are skipped, arguments may be quoted.
+    """
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        words, options = split_options(shlex.split(line))
+        try:
+            name = command_argument(words[0], words[1:])
+        except (ValueError, IndexError):
+            raise ValueError("line %d: expected 'command argument', got %r" % (number, line))
+        yield number, words[0], name, options
+
+
+def run_batch(commands, runner, defaults=None):
+    """Runs parsed batch commands in order with runner(cmd, name, options) -> (output, error).
+
+    defaults are options of every command unless its line sets them.
+    Returns a list of result dicts (line, cmd, name, output, error, seconds).
+    """
+    results = []
+    for number, cmd, name, options in commands:
+        options = dict(defaults or {}, **options)
+        start = time.time()
+        output, error = runner(cmd, name, options)
+        if error is None and "failed####" in output:
+            error = output.strip()
+        results.append({'line': number, 'cmd': cmd, 'name': name, 'output': output,
+                         'error': error, 'seconds': time.time() - start})
+        sys.stdout.write(output)
+        # --json output already has the error
+        if error and not options.get('json'): print "failed#### line %d: %s" % (number, error)
+    return results
+
+
+def print_batch_report(results, elapsed):
+    print "%-6s %-14s %-8s %10s  %s" % ("line", "command", "result", "time(ms)", "argument")
+    for result in results:
+        print "%-6d %-14s %-8s %10.1f  %s" % (result['line'], result['cmd'],
+                                              "failed" if result['error'] else "ok",
+                                              result['seconds'] * 1000, result['name'])
+    failed = len([r for r in results if r['error']])
+    print "%d commands, %d failed, %.1f ms total" % (len(results), failed, elapsed * 1000)
+
+
+def read_batch(path):
+    lines = sys.stdin.readlines() if path == "-" else open(path).readlines()
+    return list(parse_batch(lines))
+
+
+def batch(path, options=None):
+    """Runs a batch file, options apply to every line; returns the results."""
+    options = options or {}
+    commands = read_batch(path)
+
+    start = time.time()
+    if server_available():
+        results = run_batch(commands, send_command, options)
+    else:
+        session = Session(verbose=not (options.get('quiet') or options.get('json')))
+        try:
+            results = run_batch(commands, lambda cmd, name, options: execute_captured(session, cmd, name, options),
+                                options)
+        finally:
+            session.close()
+    if options.get('json'):
+        print json.dumps({'batch': path, 'commands': len(results),
+                          'failed': len([r for r in results if r['error']]), 'seconds': time.time() - start})
+    else:
+        print_batch_report(results, time.time() - start)
+    return results
+
+
+def forward_device(device):
+    """Forwards a free local port, picked by adb, to the marionette server of the device with adb serial device."""
+    output = subprocess.check_output(['adb', '-s', device, 'forward', 'tcp:0', 'tcp:%d' % MARIONETTE_PORT],
+                                     stderr=subprocess.STDOUT)
+    return int(output.split()[-1])
+
+
+def remove_forward(device, port):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call(['adb', '-s', device, 'forward', '--remove', 'tcp:%d' % port],
+                        stdout=devnull, stderr=devnull)
+
+
+def run_on_device(device, port, commands, options=None):
+    """Runs the commands on one device with its own session, never raises."""
+    options = options or {}
+    start = time.time()
+    results = []
+    error = None
+    with captured_output() as output:
+        try:
+            session = Session(port=port, verbose=not (options.get('quiet') or options.get('json')))
+            try:
+                results = run_batch(commands, lambda cmd, name, options: execute_captured(session, cmd, name, options),
+                                    options)
+            finally:
+                session.close()
+        except Exception as e:
+            error = "%s: %s" % (type(e).__name__, e)
+    return {'device': device, 'port': port, 'results': results, 'error': error,
+            'output': output.getvalue(), 'seconds': time.time() - start}
+
+
+def run_on_fleet_device(device, commands, options=None):
+    """run_on_device for a local port number or an adb serial, never raises.
+
+    A serial gets its own forward for the duration of the run; when that
+    fails the device is reported with the error and no port.
+    """
+    if device.isdigit():
+        return run_on_device(device, int(device), commands, options)
+    try:
+        port = forward_device(device)
+    except (OSError, ValueError, subprocess.CalledProcessError) as e:
+        error = getattr(e, 'output', None) or e
+        return {'device': device, 'port': None, 'results': [], 'error': "adb forward failed: %s" % str(error).strip(),
+                'output': "", 'seconds': 0.0}
+    try:
+        return run_on_device(device, port, commands, options)
+    finally:
+        remove_forward(device, port)
+
+
+def fleet(devices, commands, options=None):
+    """Runs the same commands on every device at once; returns one result per device."""
+    options = options or {}
+    pool = ThreadPool(len(devices))
+    try:
+        reports = pool.map(lambda device: run_on_fleet_device(device, commands, options), devices)
+    finally:
+        pool.close()
+
+    if options.get('json'):
+        # the output of every command is a json line already
+        for report in reports:
+            print json.dumps({'device': report['device'], 'port': report['port'], 'error': report['error'],
+                              'failed': len([r for r in report['results'] if r['error']]),
+                              'seconds': report['seconds'],
+                              'results': [json.loads(r['output'].splitlines()[-1]) for r in report['results']
+                                          if r['output'].strip()]})
+        return reports
+    for report in reports:
+        print "==== %s (port %s) ====" % (report['device'], report['port'] or "-")
+        sys.stdout.write(report['output'])
+    print "%-20s %-6s %-8s %10s  %s" % ("device", "port", "result", "time(ms)", "error")
+    for report in reports:
+        failed = [r for r in report['results'] if r['error']]
+        error = report['error'] or (failed and "%d of %d commands failed" % (len(failed), len(report['results'])))
+        print "%-20s %-6s %-8s %10.1f  %s" % (report['device'], report['port'] or "-", "failed" if error else "ok",
+                                              report['seconds'] * 1000, error or "")
+    return reports
+
+
+class CommandHandler(SocketServer.StreamRequestHandler):
+    """Runs one json encoded command per connection on the server's session."""
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # availability probe from server_available()
+            return
+        request = json.loads(line)
+        if request['cmd'] == 'stop':
+            self.server.stopping = True
+            self.reply("server stopped\n")
+            return
+
+        # file names are relative to the client's directory, requests are handled one at a time
+        previous = os.getcwd()
+        os.chdir(request.get('cwd') or previous)
+        try:
+            output, error = execute_captured(self.server.session, request['cmd'], request['name'],
+                                             request.get('options'))
+        finally:
+            os.chdir(previous)
+        self.reply(output, error)
+
+    def reply(self, output, error=None):
+        self.wfile.write(json.dumps({'output': output, 'error': error}) + '\n')
+
+
+class CommandServer(SocketServer.UnixStreamServer):
+    """Keeps one marionette session (and its imported atoms) warm between commands."""
+
+    def __init__(self, path, session):
+        if server_available(path):
+            raise socket.error(errno.EADDRINUSE, "a server is already running on %s" % path)
+        if os.path.exists(path):
+            # stale socket left behind by a server that died
+            os.remove(path)
+        SocketServer.UnixStreamServer.__init__(self, path, CommandHandler)
+        self.session = session
+        self.stopping = False
+
+    def serve_until_stopped(self):
+        try:
+            while not self.stopping:
+                self.handle_request()
+        finally:
+            self.server_close()
+            os.remove(self.server_address)
+
+
+def serve(path=SOCKET_PATH):
+    session = Session()
+    server = CommandServer(path, session)
+    print "serving on %s" % path
+    try:
+        server.serve_until_stopped()
+    finally:
+        session.close()
+
+
+def server_available(path=SOCKET_PATH):
+    if not os.path.exists(path):
+        return False
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        # stale socket left behind by a server that died
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+def send_command(cmd, name, options=None, path=SOCKET_PATH):
+    """Forwards a command to a running "serve" process; returns (output, error)."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps({'cmd': cmd, 'name': name, 'options': options, 'cwd': os.getcwd()}) + '\n')
+        reply = json.loads(sock.makefile('rb').readline())
+    finally:
+        sock.close()
+    return reply['output'], reply['error']
+
+
+def main(argv):
+    argv, options = split_options(argv)
+
+    if len(argv) >= 2 and argv[1] in ("serve", "stop"):
+        cmd = argv[1]
+        name = argv[2] if len(argv) == 3 else SOCKET_PATH
+    elif len(argv) >= 5 and argv[1] == "fleet":
+        cmd = argv[1]
+        name = argv[2].split(",")
+    elif len(argv) > 3 and argv[1] in MULTI_ARG_COMMANDS:
+        cmd = argv[1]
+        name = argv[2:]
+    elif len(argv) == 3:
+        cmd = argv[1]
+        name = argv[2]
+    elif len(argv) == 2 and argv[1] in OPTION_COMMANDS:
+        cmd = argv[1]
+        name = None
+    else :
+        print "parameters format not correct!"
+        print USAGE % {'prog': argv[0], 'sym': SPLIT_SYM}
+        return EXIT_USAGE
+
+    if(cmd == "serve"):
+        if server_available(name):
+            # checked before opening a session, which would take the device from the running server
+            print "a server is already running on %s" % name
+            return EXIT_FAILED
+        serve(name)
+        return EXIT_OK
+    if(cmd == "stop"):
+        if not server_available(name):
+            print "no server running on %s" % name
+            return EXIT_FAILED
+        output, error = send_command(cmd, None, path=name)
+        sys.stdout.write(output)
+        return EXIT_OK
+    if(cmd == "batch"):
+        results = batch(name, options)
+        return EXIT_FAILED if any(r['error'] for r in results) else EXIT_OK
+    if(cmd == "bench-host"):
+        try:
+            bench_host(options)
+        except CommandFailed as e:
+            print "failed#### %s: %s" % (type(e).__name__, e)
+            return EXIT_FAILED
+        return EXIT_OK
+    if(cmd == "fleet"):
+        if argv[3] == "batch":
+            commands = read_batch(argv[4])
+        else:
+            commands = [(1, argv[3], command_argument(argv[3], argv[4:]), {})]
+        reports = fleet(name, commands, options)
+        failed = any(report['error'] or any(r['error'] for r in report['results']) for report in reports)
+        return EXIT_FAILED if failed else EXIT_OK
+
+    if server_available():
+        output, error = send_command(cmd, name, options)
+        sys.stdout.write(output)
+        if error and not options.get('json'): print "failed#### %s" % error
+        return exit_code(error)
+
+    start = time.time()
+    try:
+        session = Session(verbose=not (options.get('quiet') or options.get('json')))
+    except Exception as e:
+        error = "%s: %s" % (type(e).__name__, e)
+        if options.get('json'): print json_record(cmd, name, error=error, seconds=time.time() - start)
+        else: print "failed#### %s" % error
+        return EXIT_ERROR
+    error = None
+    try:
+        execute(session, cmd, name, options)
+    except Exception as e:
+        error = "%s: %s" % (type(e).__name__, e)
+        if not options.get('json'): print "failed#### %s" % error
 #complete session
-    client.delete_session()
+    session.close()
+    return exit_code(error)
 
 if __name__ == "__main__":
-   main(sys.argv)
+   sys.exit(main(sys.argv))
@@ -121,4 +121,74 @@ var Accessibility = {
         { result: this._accRetrieval.getStringRole(acc.role) });
     });
   },
+
+  _describe: function Accessibility__describe(acc, ariaHidden) {
+    if (!acc) {
+      return { accessible: false, name: null, role: null, states: [],
+               hidden: true, visible: false, disabled: null };
+    }
+    let state = {};
+    let extState = {};
+    acc.getState(state, extState);
+    let names = this._accRetrieval.getStringStates(state.value, extState.value);
+    let states = [];
+    for (let i = 0; i < names.length; i++) {
+      states.push(names.item(i));
+    }
+    let invisible = this._matchState(acc, 'STATE_INVISIBLE');
+    return {
+      accessible: true,
+      name: acc.name,
+      role: this._accRetrieval.getStringRole(acc.role),
+      states: states,
+      hidden: ariaHidden || invisible,
+      visible: !ariaHidden && !invisible,
+      disabled: this._matchState(acc, 'STATE_UNAVAILABLE')
+    };
+  },
+
+  /**
+   * Finishes with name, role and states of all elements, or of all elements
+   * matching selector when elements is null, in order. Accessibles are
+   * polled for all elements together until aTimeout ms have passed; elements
+   * hidden by aria-hidden are not waited for, as in isHidden.
+   */
+  describe: function Accessibility_describe(elements, selector, aTimeout) {
+    let found = elements ||
+      Array.prototype.slice.call(document.querySelectorAll(selector));
+    let targets = found.map((element) => element.wrappedJSObject);
+    let ariaHidden = targets.map((element) => !!this._isAriaHidden(element));
+    let accs = targets.map(() => null);
+    let deadline = Date.now() + aTimeout;
+
+    let poll = () => {
+      let pending = 0;
+      targets.forEach((element, index) => {
+        if (!accs[index]) {
+          accs[index] = this._accRetrieval.getAccessibleFor(element);
+          pending += (!accs[index] && !ariaHidden[index]) ? 1 : 0;
+        }
+      });
+      if (pending && Date.now() < deadline) {
+        setTimeout(poll, 10);
+        return;
+      }
+      if (pending) {
+        console.log('accessibility.js: no accessible for ' + pending +
+          ' of ' + targets.length + ' elements');
+      }
+      try {
+        marionetteScriptFinished({ result: found.map((element, index) => {
+          let description = this._describe(accs[index], ariaHidden[index]);
+          if (!elements) {
+            description.element = element;
+          }
+          return description;
+        }) });
+      } catch (e) {
+        marionetteScriptFinished({ error: e.message });
+      }
+    };
+    poll();
+  },
 };
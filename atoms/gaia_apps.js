@@ -5,7 +5,24 @@
 'use strict';
 /* globals marionetteScriptFinished */
 
-function waitFor(callback, test, timeout) {
+/**
+ * Calls callback once test() returns true.
+ *
+ * aOptions.events is a list of [target, eventType] pairs; test() is checked
+ * again as soon as one of them fires, so the wait ends on the platform event
+ * instead of on the next poll. The state may settle shortly after its event
+ * (an app can still be listed right after appterminated), so for
+ * waitFor.fallbackInterval ms after an event test() is polled every
+ * waitFor.interval ms. Otherwise polling every aOptions.interval ms (defaults
+ * to waitFor.interval, or waitFor.fallbackInterval when events are given)
+ * is kept as a fallback for changes that send no event.
+ */
+function waitFor(callback, test, timeout, aOptions) {
+    let options = aOptions || {};
+    let events = options.events || [];
+    let interval = options.interval ||
+        (events.length ? waitFor.fallbackInterval : waitFor.interval);
+
     if (test()) {
       callback();
       return;
@@ -14,15 +31,57 @@ function waitFor(callback, test, timeout) {
     let now = new Date();
     let deadline = (timeout instanceof Date) ? timeout :
         new Date(now.valueOf() + timeout);
-    if (deadline <= now) {
-      dump("waitFor timeout: " + test.toString() + "\n");
-      // the script will timeout here, so no need to raise a separate
-      // timeout exception
-      return;
-    }
-    window.setTimeout(waitFor, 100, callback, test, deadline);
+    let timer = null;
+    let done = false;
+    let lastEvent = null;
+
+    let finish = function() {
+      done = true;
+      window.clearTimeout(timer);
+      events.forEach(function(aEvent) {
+        aEvent[0].removeEventListener(aEvent[1], onEvent);
+      });
+    };
+
+    let check = function() {
+      if (done) {
+        return;
+      }
+      if (test()) {
+        finish();
+        callback();
+        return;
+      }
+      if (deadline <= new Date()) {
+        dump("waitFor timeout: " + test.toString() + "\n");
+        // the script will timeout here, so no need to raise a separate
+        // timeout exception
+        finish();
+        return;
+      }
+      let settling = lastEvent !== null &&
+                     Date.now() - lastEvent < waitFor.fallbackInterval;
+      window.clearTimeout(timer);
+      timer = window.setTimeout(check, settling ?
+                                Math.min(interval, waitFor.interval) : interval);
+    };
+
+    let onEvent = function() {
+      lastEvent = Date.now();
+      check();
+    };
+
+    events.forEach(function(aEvent) {
+      aEvent[0].addEventListener(aEvent[1], onEvent);
+    });
+    check();
 }
 
+// polling interval (ms) of waits without events
+waitFor.interval = 100;
+// polling interval (ms) of waits that are woken up by events
+waitFor.fallbackInterval = 1000;
+
 var GaiaApps = {
 
   normalizeName: function(name) {
@@ -212,6 +271,10 @@ var GaiaApps = {
     var app = apps.getByManifestURL(manifestURL);
     var appName, launchPath;
 
+    if (!app) {
+      callback(false);
+      return;
+    }
     if (entryPoint) {
       if (app.manifest.entry_points[entryPoint]) {
         appName = app.manifest.entry_points[entryPoint].name;
@@ -226,6 +289,63 @@ var GaiaApps = {
     GaiaApps.sendLocateResponse(callback, app, appName, launchPath, entryPoint);
   },
 
+  // Number of apps installed or uninstalled since the system app started,
+  // an app index built at an older generation may be out of date.
+  getAppIndexGeneration: function() {
+    let win = window.wrappedJSObject;
+    if (win.gaiaAppsIndexGeneration === undefined) {
+      win.gaiaAppsIndexGeneration = 0;
+      let changed = function() {
+        win.gaiaAppsIndexGeneration++;
+      };
+      navigator.mozApps.mgmt.addEventListener('install', changed);
+      navigator.mozApps.mgmt.addEventListener('uninstall', changed);
+    }
+    return win.gaiaAppsIndexGeneration;
+  },
+
+  // Returns every launchable name of the installed apps, in the order
+  // locateWithName searches them: one entry per app or entry point with its
+  // normalized name first and then its normalized localised names.
+  getAppIndex: function() {
+    let apps = window.wrappedJSObject.applications ||
+                window.wrappedJSObject.Applications;
+    let installedApps = apps.installedApps;
+    let generation = GaiaApps.getAppIndexGeneration();
+    let entries = [];
+
+    let addEntry = function(app, manifest, entryPoint) {
+      let names = [GaiaApps.normalizeName(manifest.name)];
+      for (let id in (manifest.locales || {})) {
+        if (manifest.locales[id].name) {
+          names.push(GaiaApps.normalizeName(manifest.locales[id].name));
+        }
+      }
+      entries.push({
+        manifestURL: app.manifestURL,
+        origin: app.origin,
+        entryPoint: entryPoint || null,
+        appName: app.manifest.name,
+        name: manifest.name,
+        role: app.manifest.role || null,
+        names: names
+      });
+    };
+
+    for (let manifestURL in installedApps) {
+      let app = installedApps[manifestURL];
+      let entryPoints = app.manifest.entry_points;
+      if (entryPoints) {
+        for (let ep in entryPoints) {
+          addEntry(app, entryPoints[ep], ep);
+        }
+      } else {
+        addEntry(app, app.manifest);
+      }
+    }
+    return {generation: generation, apps: entries};
+  },
+
   // Returns the number of running apps.
   // if includeSystemApps is true then system always-running
   // apps (eg Homescreen) will be counted
@@ -250,18 +370,19 @@ var GaiaApps = {
       callback(false);
     }
     else {
-      window.addEventListener('appterminated', function gt_onAppTerminated() {
-        window.removeEventListener('appterminated', gt_onAppTerminated);
-        waitFor(
-          function() {
-            console.log('app with origin \'' + aOrigin + '\' has terminated');
-            callback(true);
-          },
-          function() {
-            return !GaiaApps.isRunning(aOrigin);
-          }
-        );
-      });
+      // Even after the 'appterminated' event has been fired the app can
+      // still be listed for a moment, so the event only triggers the check.
+      waitFor(
+        function() {
+          console.log('app with origin \'' + aOrigin + '\' has terminated');
+          callback(true);
+        },
+        function() {
+          return !GaiaApps.isRunning(aOrigin);
+        },
+        undefined,
+        { events: [[window, 'appterminated']] }
+      );
       console.log('terminating app with origin \'' + aOrigin + '\'');
       let manager = window.wrappedJSObject.appWindowManager ||
                     new window.wrappedJSObject.AppWindowManager();
@@ -295,7 +416,9 @@ var GaiaApps = {
     // apps are running (since we don't close the homescreen app).
     waitFor(
       function() { marionetteScriptFinished(true); },
-      function() { return that.numRunningApps() <= 1; }
+      function() { return that.numRunningApps() <= 1; },
+      undefined,
+      { events: [[window, 'appterminated']] }
     );
   },
 
@@ -322,19 +445,18 @@ var GaiaApps = {
         console.log('app with origin \'' + origin + '\' is already running');
         sendResponse();
       } else {
-        window.addEventListener('appopen', function appOpen() {
-          window.removeEventListener('appopen', appOpen);
-          waitFor(
-            function() {
-              console.log('app with origin \'' + origin + '\' has launched');
-              sendResponse();
-            },
-            function() {
-              // wait for the displayed app to have the expected source URL
-              return GaiaApps.getDisplayedApp().src == (origin + launchPath);
-            }
-          );
-        });
+        waitFor(
+          function() {
+            console.log('app with origin \'' + origin + '\' has launched');
+            sendResponse();
+          },
+          function() {
+            // wait for the displayed app to have the expected source URL
+            return GaiaApps.getDisplayedApp().src == (origin + launchPath);
+          },
+          undefined,
+          { events: [[window, 'appopen'], [window, 'appopened']] }
+        );
         console.log('launching app with name \'' + appName + '\'');
         app.launch(entryPoint || null);
       }
@@ -358,7 +480,16 @@ var GaiaApps = {
   //
   // This is prefered over launchWithName because localized builds have
   // different names
-  launchWithManifestURL: function(manifestURL, entryPoint) {
+  //
+  // When aGeneration is given and apps were installed or uninstalled since,
+  // returns {stale: true} without launching so the caller can look the app
+  // up again.
+  launchWithManifestURL: function(manifestURL, entryPoint, aGeneration) {
+    if (aGeneration !== undefined &&
+        aGeneration !== GaiaApps.getAppIndexGeneration()) {
+      marionetteScriptFinished({stale: true});
+      return;
+    }
     GaiaApps.locateWithManifestURL(manifestURL, entryPoint, this.launch);
   },
 
@@ -408,6 +539,57 @@ var GaiaApps = {
     return result;
   },
 
+  /**
+   * Finishes once the homescreen has loaded and the boot logo is hidden,
+   * with the ms each took from the call. Checks again on every DOM change
+   * and transition/animation end of the system app, and every
+   * waitFor.fallbackInterval ms.
+   */
+  waitForSystemReady: function() {
+    let start = Date.now();
+    let times = {homescreen: null, logo: null};
+
+    let logoHidden = function() {
+      let logo = document.getElementById('os-logo');
+      if (!logo) {
+        return true;
+      }
+      let style = window.getComputedStyle(logo);
+      return logo.hidden || style.display === 'none' ||
+             style.visibility === 'hidden' || style.opacity === '0' ||
+             !logo.offsetWidth;
+    };
+
+    let timer = null;
+    let check = function() {
+      if (times.homescreen === null &&
+          document.querySelector('#homescreen[loading-state=false]')) {
+        times.homescreen = Date.now() - start;
+      }
+      if (times.homescreen !== null && times.logo === null && logoHidden()) {
+        times.logo = Date.now() - start;
+      }
+      if (times.logo === null) {
+        // fallback for changes that are neither DOM changes nor transitions
+        window.clearTimeout(timer);
+        timer = window.setTimeout(check, waitFor.fallbackInterval);
+        return;
+      }
+      observer.disconnect();
+      window.removeEventListener('transitionend', check);
+      window.removeEventListener('animationend', check);
+      window.clearTimeout(timer);
+      marionetteScriptFinished(times);
+    };
+
+    let observer = new MutationObserver(check);
+    observer.observe(document.documentElement,
+                     {attributes: true, childList: true, subtree: true});
+    window.addEventListener('transitionend', check);
+    window.addEventListener('animationend', check);
+    check();
+  },
+
   /**
    * Uninstalls the app with the specified name.
    */
@@ -4,12 +4,15 @@
 
 'use strict';
 /* global marionetteScriptFinished, pair, device:true, mozContact, i */
-/* global SpecialPowers, adapter:true, aContacts */
+/* global SpecialPowers, adapter:true, aContacts, Components */
 /* exported pair, discovery, GaiaDataLayer */
 /* jshint -W083 */
 
 var GaiaDataLayer = {
 
+  // number of requests the bulk insert/removal paths keep in flight at once
+  BULK_CONCURRENCY: 8,
+
   getBluetoothDefaultAdapter: function() {
     var bluetooth = window.navigator.mozBluetooth;
     if (bluetooth.defaultAdapter) {
@@ -116,6 +119,34 @@ var GaiaDataLayer = {
     };
   },
 
+  // Saves many contacts keeping aConcurrency saves in flight. Returns
+  // {ids, failed, seconds} where ids follow the order of aContacts and
+  // hold null for the contacts that failed.
+  insertContacts: function(aContacts, aConcurrency, aCallback) {
+    // requires the 'contacts-create' permission
+    var callback = aCallback || marionetteScriptFinished;
+    var self = this;
+    var start = Date.now();
+    this._inParallel(aContacts, function(aContact, aDone) {
+      if (aContact.photo) {
+        aContact.photo = [self.base64ToBlob(aContact.photo, 'image/jpg')];
+      }
+      var contact = new mozContact(aContact);
+      var req = window.navigator.mozContacts.save(contact);
+      req.onsuccess = function() {
+        aDone(contact.id);
+      };
+      req.onerror = function() {
+        console.error('error saving contact', req.error.name);
+        aDone(null);
+      };
+    }, aConcurrency, 'saved', start, function(aIds) {
+      callback({ids: aIds,
+                failed: aIds.filter(function(aId) { return !aId; }).length,
+                seconds: (Date.now() - start) / 1000});
+    });
+  },
+
   insertSIMContact: function(aType, aContact) {
 
     // Get 1st SIM
@@ -138,7 +169,8 @@ var GaiaDataLayer = {
     };
   },
 
-  deleteSIMContact: function(aType, aId) {
+  deleteSIMContact: function(aType, aId, aCallback) {
+    var callback = aCallback || marionetteScriptFinished;
 
     // Get 1st SIM
     var iccId = window.navigator.mozIccManager.iccIds[0];
@@ -150,14 +182,26 @@ var GaiaDataLayer = {
     var req = icc.updateContact(aType, aContact);
     req.onsuccess = function() {
       console.log('success removing contact from SIM');
-      marionetteScriptFinished(true);
+      callback(true);
     };
     req.onerror = function() {
       console.error('error removing contact from SIM', req.error.name);
-      marionetteScriptFinished(false);
+      callback(false);
     };
   },
 
+  removeAllSIMContacts: function(aType, aConcurrency, aCallback) {
+    var type = aType || 'adn';
+    var callback = aCallback || marionetteScriptFinished;
+    var self = this;
+    var start = Date.now();
+    this.getSIMContacts(type, function(aContacts) {
+      self._removeInParallel(aContacts, function(aContact, aDone) {
+        self.deleteSIMContact(type, aContact.id, aDone);
+      }, aConcurrency, start, callback);
+    });
+  },
+
   getAllContacts: function(aCallback) {
     // requires 'contacts-read' permission
     var callback = aCallback || marionetteScriptFinished;
@@ -194,25 +238,100 @@ var GaiaDataLayer = {
     };
   },
 
-  removeAllContacts: function() {
+  getContactsCount: function(aCallback) {
+    // requires 'contacts-read' permission
+    var callback = aCallback || marionetteScriptFinished;
+    var req = window.navigator.mozContacts.getCount();
+    req.onsuccess = function() {
+      callback(req.result);
+    };
+    req.onerror = function() {
+      console.error('error counting contacts ' + req.error.name);
+      callback(false);
+    };
+  },
+
+  // Removes all contacts, with a single mozContacts.clear() where the API has
+  // it and otherwise keeping aConcurrency removals in flight. Returns
+  // {method, removed, failed, seconds, perSecond}.
+  removeAllContacts: function(aConcurrency, aCallback) {
+    var callback = aCallback || marionetteScriptFinished;
     var self = this;
-    this.getAllContacts(function(aContacts) {
-      if (aContacts.length > 0) {
-        var contactsLength = aContacts.length;
-        var done = 0;
-        for (var i = 0; i < contactsLength; i++) {
-          self.removeContact(aContacts[i], function() {
-            if (++done === contactsLength) {
-              marionetteScriptFinished(true);
-            }
-          });
+    var start = Date.now();
+    var removeEach = function() {
+      self.getAllContacts(function(aContacts) {
+        self._removeInParallel(aContacts, function(aContact, aDone) {
+          self.removeContact(aContact, aDone);
+        }, aConcurrency, start, callback);
+      });
+    };
+
+    if (!window.navigator.mozContacts.clear) {
+      removeEach();
+      return;
+    }
+    var req = window.navigator.mozContacts.clear();
+    req.onsuccess = function() {
+      console.log('success clearing contacts');
+      callback({method: 'clear', removed: null, failed: 0,
+                seconds: (Date.now() - start) / 1000, perSecond: null});
+    };
+    req.onerror = function() {
+      console.error('error clearing contacts ' + req.error.name +
+                    ', removing them one by one');
+      removeEach();
+    };
+  },
+
+  _removeInParallel: function(aItems, aRemove, aConcurrency, aStart, aCallback) {
+    this._inParallel(aItems, aRemove, aConcurrency, 'removed', aStart,
+      function(aResults) {
+        var failed = aResults.filter(function(aSuccess) {
+          return !aSuccess;
+        }).length;
+        var removed = aResults.length - failed;
+        var seconds = (Date.now() - aStart) / 1000;
+        aCallback({method: 'parallel', removed: removed, failed: failed,
+                   seconds: seconds,
+                   perSecond: seconds ? removed / seconds : null});
+      });
+  },
+
+  // Calls aTask(item, done) for every item with at most aConcurrency tasks
+  // running, logging progress as aVerb; aCallback gets the values passed to
+  // done, in the order of aItems.
+  _inParallel: function(aItems, aTask, aConcurrency, aVerb, aStart, aCallback) {
+    var concurrency = aConcurrency || this.BULK_CONCURRENCY;
+    var total = aItems.length;
+    var results = new Array(total);
+    var next = 0;
+    var done = 0;
+
+    var runNext = function() {
+      var index = next++;
+      aTask(aItems[index], function(aResult) {
+        results[index] = aResult;
+        done++;
+        if (done % 100 === 0 || done === total) {
+          console.log(aVerb + ' ' + done + '/' + total + ' (' +
+            Math.round(done * 1000 / (Date.now() - aStart || 1)) + '/s)');
         }
-      }
-      else {
-        console.log('no contacts to remove');
-          marionetteScriptFinished(true);
-      }
-    });
+        if (done === total) {
+          aCallback(results);
+        } else if (next < total) {
+          runNext();
+        }
+      });
+    };
+
+    if (!total) {
+      console.log('nothing ' + aVerb);
+      aCallback(results);
+      return;
+    }
+    for (var i = 0; i < Math.min(concurrency, total); i++) {
+      runNext();
+    }
   },
 
   removeContact: function(aContact, aCallback) {
@@ -226,7 +345,7 @@ var GaiaDataLayer = {
     };
     req.onerror = function() {
       console.error('error removing contact with id \'' +
-                      aContacts[i].id + '\'');
+                      aContact.id + '\'');
       callback(false);
     };
   },
@@ -265,6 +384,243 @@ var GaiaDataLayer = {
     };
   },
 
+  getSettings: function(aNames, aCallback) {
+    // requires the 'settings-read' and 'settings-api-read' permissions
+    var callback = aCallback || marionetteScriptFinished;
+    var lock = window.navigator.mozSettings.createLock();
+    var result = {};
+    aNames.forEach(function(aName) {
+      var req = lock.get(aName);
+      req.onsuccess = function() {
+        result[aName] = req.result[aName];
+      };
+    });
+    lock.onsettingstransactionsuccess = function() {
+      console.log(aNames.length + ' settings retrieved');
+      callback(result);
+    };
+    lock.onsettingstransactionfailure = function() {
+      console.log('error getting settings');
+      callback(false);
+    };
+  },
+
+  setSettings: function(aSettings, aCallback) {
+    // requires the 'settings-write' and 'settings-api-write' permissions
+    var callback = aCallback || marionetteScriptFinished;
+    var names = Object.keys(aSettings);
+    var result = {};
+    console.log('setting ' + names.length + ' settings');
+    var lock = window.navigator.mozSettings.createLock();
+    lock.set(aSettings);
+    // requests on a lock run in order, so these reads see the values written
+    // above and the whole change is verified in the same transaction
+    names.forEach(function(aName) {
+      var req = lock.get(aName);
+      req.onsuccess = function() {
+        result[aName] = req.result[aName];
+      };
+    });
+    lock.onsettingstransactionsuccess = function() {
+      console.log('settings changed');
+      callback(result);
+    };
+    lock.onsettingstransactionfailure = function() {
+      console.log('error changing settings');
+      callback(false);
+    };
+  },
+
+  // JSON with sorted object keys, so equal values compare equal.
+  _canonical: function(aValue) {
+    return JSON.stringify(aValue, function(aKey, aItem) {
+      if (aItem && typeof aItem === 'object' && !Array.isArray(aItem)) {
+        var sorted = {};
+        Object.keys(aItem).sort().forEach(function(aName) {
+          sorted[aName] = aItem[aName];
+        });
+        return sorted;
+      }
+      return aItem;
+    });
+  },
+
+  // Returns {name: value} of Gecko prefs of any type, null when unset.
+  // Requires special powers.
+  _getPrefs: function(aNames) {
+    var prefs = SpecialPowers.Services.prefs;
+    var result = {};
+    aNames.forEach(function(aName) {
+      switch (prefs.getPrefType(aName)) {
+        case prefs.PREF_BOOL:
+          result[aName] = prefs.getBoolPref(aName);
+          break;
+        case prefs.PREF_INT:
+          result[aName] = prefs.getIntPref(aName);
+          break;
+        case prefs.PREF_STRING:
+          result[aName] = prefs.getCharPref(aName);
+          break;
+        default:
+          result[aName] = null;
+      }
+    });
+    return result;
+  },
+
+  _setPref: function(aName, aValue) {
+    var prefs = SpecialPowers.Services.prefs;
+    if (aValue === null) {
+      prefs.clearUserPref(aName);
+    } else if (typeof aValue === 'boolean') {
+      prefs.setBoolPref(aName, aValue);
+    } else if (typeof aValue === 'number') {
+      prefs.setIntPref(aName, aValue);
+    } else {
+      prefs.setCharPref(aName, aValue);
+    }
+  },
+
+  // Known networks without their connection state, as a snapshot keeps them.
+  _getNetworks: function(aCallback) {
+    if (!window.navigator.mozWifiManager) {
+      aCallback(null, []);
+      return;
+    }
+    this.getKnownNetworks(function(aNetworks) {
+      var networks = aNetworks.filter(function(aNetwork) {
+        return aNetwork;
+      });
+      aCallback(networks.map(function(aNetwork) {
+        return {ssid: aNetwork.ssid, security: aNetwork.security,
+                hidden: !!aNetwork.hidden};
+      }), networks);
+    });
+  },
+
+  // Returns every setting (except blobs, which can't be restored from
+  // JSON), the given prefs and the known Wi-Fi networks in one call.
+  getSnapshot: function(aPrefs, aCallback) {
+    var callback = aCallback || marionetteScriptFinished;
+    var self = this;
+    var req = window.navigator.mozSettings.createLock().get('*');
+    req.onsuccess = function() {
+      var settings = {};
+      for (var name in req.result) {
+        if (!(req.result[name] instanceof window.Blob)) {
+          settings[name] = req.result[name];
+        }
+      }
+      self._getNetworks(function(aNetworks) {
+        callback({settings: settings, prefs: self._getPrefs(aPrefs),
+                  networks: aNetworks});
+      });
+    };
+    req.onerror = function() {
+      console.log('error getting settings ' + req.error.name);
+      callback(false);
+    };
+  },
+
+  // Compares a getSnapshot() result with the device and writes only what
+  // differs: changed settings in one transaction, changed prefs, forgets
+  // networks missing from the snapshot and adds the ones it has credentials
+  // for. Returns the names changed per kind; networks the snapshot has no
+  // credentials for are reported as missing.
+  applySnapshot: function(aSnapshot, aCallback) {
+    var callback = aCallback || marionetteScriptFinished;
+    var self = this;
+    var start = Date.now();
+    var result = {settings: [], prefs: [], forgotten: [], added: [],
+                  missing: []};
+
+    var finish = function() {
+      result.seconds = (Date.now() - start) / 1000;
+      callback(result);
+    };
+
+    var applyNetworks = function() {
+      if (!aSnapshot.networks) {
+        finish();
+        return;
+      }
+      self._getNetworks(function(aKnown, aNetworks) {
+        if (aKnown === null) {
+          finish();
+          return;
+        }
+        var wanted = aSnapshot.networks.map(function(aNetwork) {
+          return aNetwork.ssid;
+        });
+        var known = aKnown.map(function(aNetwork) {
+          return aNetwork.ssid;
+        });
+        var tasks = [];
+        aNetworks.forEach(function(aNetwork) {
+          if (wanted.indexOf(aNetwork.ssid) === -1) {
+            tasks.push(function(aDone) {
+              result.forgotten.push(aNetwork.ssid);
+              self.forgetWiFi(aNetwork, aDone, false);
+            });
+          }
+        });
+        aSnapshot.networks.forEach(function(aNetwork) {
+          if (known.indexOf(aNetwork.ssid) > -1) {
+            return;
+          }
+          if (!(aNetwork.password || aNetwork.psk || aNetwork.wep ||
+                aNetwork.identity) && aNetwork.security.length) {
+            result.missing.push(aNetwork.ssid);
+            return;
+          }
+          tasks.push(function(aDone) {
+            result.added.push(aNetwork.ssid);
+            var manager = window.navigator.mozWifiManager;
+            var req = manager.associate(window.MozWifiNetwork === undefined ?
+              aNetwork : new window.MozWifiNetwork(aNetwork));
+            req.onsuccess = req.onerror = function() { aDone(); };
+          });
+        });
+        self._inParallel(tasks, function(aTask, aDone) {
+          aTask(aDone);
+        }, 1, 'network changes', start, finish);
+      });
+    };
+
+    var live = this._getPrefs(Object.keys(aSnapshot.prefs || {}));
+    for (var name in aSnapshot.prefs || {}) {
+      if (live[name] !== aSnapshot.prefs[name]) {
+        self._setPref(name, aSnapshot.prefs[name]);
+        result.prefs.push(name);
+      }
+    }
+
+    var lock = window.navigator.mozSettings.createLock();
+    var req = lock.get('*');
+    req.onsuccess = function() {
+      var changed = {};
+      for (var name in aSnapshot.settings) {
+        if (self._canonical(req.result[name]) !==
+            self._canonical(aSnapshot.settings[name])) {
+          changed[name] = aSnapshot.settings[name];
+          result.settings.push(name);
+        }
+      }
+      if (result.settings.length) {
+        // same lock, so the write is based on the values just compared
+        lock.set(changed);
+      }
+    };
+    lock.onsettingstransactionsuccess = function() {
+      console.log(result.settings.length + ' settings changed');
+      applyNetworks();
+    };
+    lock.onsettingstransactionfailure = function() {
+      console.log('error restoring settings');
+      callback(false);
+    };
+  },
+
   connectToWiFi: function(aNetwork, aCallback) {
     var callback = aCallback || marionetteScriptFinished;
     var manager = window.navigator.mozWifiManager;
@@ -293,7 +649,9 @@ var GaiaDataLayer = {
           function() {
             console.log('connection status: ' + manager.connection.status);
             return manager.connection.status === 'connected';
-          }
+          },
+          undefined,
+          { events: [[manager, 'statuschange']] }
         );
       };
 
@@ -312,7 +670,10 @@ var GaiaDataLayer = {
         function() {
           console.log('wifi enabled status: ' + manager.enabled);
           return manager.enabled === false;
-      });
+        },
+        undefined,
+        { events: [[manager, 'disabled']] }
+      );
       this.setSetting('wifi.enabled', false, false);
     }
     else {
@@ -329,7 +690,10 @@ var GaiaDataLayer = {
         function() {
           console.log('wifi enabled status: ' + manager.enabled);
           return manager.enabled === true;
-      });
+        },
+        undefined,
+        { events: [[manager, 'enabled']] }
+      );
       this.setSetting('wifi.enabled', true, false);
     }
     else {
@@ -378,7 +742,9 @@ var GaiaDataLayer = {
 
   forgetWiFi: function(aNetwork, aCallback, aWaitForStatus) {
     var callback = aCallback || marionetteScriptFinished;
-    var waitForStatus = aWaitForStatus || 'disconnected';
+    // false skips the wait, e.g. for a saved network that is not the connected one
+    var waitForStatus = aWaitForStatus === false ? false :
+                        aWaitForStatus || 'disconnected';
     var manager = window.navigator.mozWifiManager;
     var req = manager.forget(aNetwork);
 
@@ -393,7 +759,9 @@ var GaiaDataLayer = {
           function() {
             console.log('connection status: ' + manager.connection.status);
             return manager.connection.status === waitForStatus;
-          }
+          },
+          undefined,
+          { events: [[manager, 'statuschange']] }
         );
       }
       else {
@@ -432,7 +800,9 @@ var GaiaDataLayer = {
           console.log('cell data enabled');
           marionetteScriptFinished(true);
         },
-        function() { return manager.data.connected; }
+        function() { return manager.data.connected; },
+        undefined,
+        { events: [[manager, 'datachange']] }
       );
       this.setSetting('ril.data.enabled', true, false);
     }
@@ -454,7 +824,9 @@ var GaiaDataLayer = {
             console.log('cell data disabled');
             marionetteScriptFinished(true);
           },
-          function() { return !manager.data.connected; }
+          function() { return !manager.data.connected; },
+          undefined,
+          { events: [[manager, 'datachange']] }
         );
         self.setSetting('ril.data.enabled', false, false);
       }
@@ -584,6 +956,361 @@ var GaiaDataLayer = {
     };
   },
 
+  // Returns up to aPageSize files of storage aType matching aFilter as
+  // {files, token}; pass token back to continue, it is null at the end.
+  // aFilter may hold extensions (list of name suffixes), minSize, maxSize,
+  // since and before (last modified, ms since epoch) and prefix (directory
+  // to enumerate), pass the same one for every page. The enumeration
+  // cursor stays open on the window under the token, so every page goes on
+  // where the previous one stopped instead of walking the storage again.
+  // A cursor is dropped at the end of its enumeration, by closeFilesPage or
+  // once unused for FILE_CURSOR_TTL ms.
+  getFilesPage: function(aType, aFilter, aPageSize, aToken, aCallback) {
+    var callback = aCallback || marionetteScriptFinished;
+    var filter = aFilter || {};
+    var files = [];
+    var win = window.wrappedJSObject;
+    var cursors = this._fileCursors();
+    var token = aToken;
+    var req;
+    if (token) {
+      req = cursors[token];
+      if (!req) {
+        console.error('no file enumeration open for token ' + token);
+        callback(false);
+        return;
+      }
+      win.gaiaFileCursorTimes[token] = Date.now();
+    } else {
+      var storage = navigator.getDeviceStorage(aType);
+      var options = filter.since ? {since: new Date(filter.since)} : {};
+      req = filter.prefix ? storage.enumerate(filter.prefix, options) :
+                            storage.enumerate(options);
+      win.gaiaFileCursorCount = (win.gaiaFileCursorCount || 0) + 1;
+      token = aType + ':' + win.gaiaFileCursorCount;
+      win.gaiaFileCursorTimes[token] = Date.now();
+      cursors[token] = req;
+    }
+
+    var matches = function(file) {
+      if (aType === 'music' && file.name.slice(-4) === '.3gp') {
+        // 3gp is both music and video; we skip the music definition
+        return false;
+      }
+      if (filter.extensions && !filter.extensions.some(function(aExtension) {
+            return file.name.slice(-aExtension.length) === aExtension;
+          })) {
+        return false;
+      }
+      if ((filter.minSize && file.size < filter.minSize) ||
+          (filter.maxSize && file.size > filter.maxSize)) {
+        return false;
+      }
+      return !(filter.before && file.lastModified >= filter.before);
+    };
+
+    req.onsuccess = function() {
+      var file = req.result;
+      if (!file) {
+        delete cursors[token];
+        delete win.gaiaFileCursorTimes[token];
+        callback({files: files, token: null});
+        return;
+      }
+      if (matches(file)) {
+        // File.name returns a fully qualified path
+        files.push({'name': file.name, 'size': file.size,
+                    'lastModified': file.lastModified});
+        if (files.length >= aPageSize) {
+          callback({files: files, token: token});
+          return;
+        }
+      }
+      req.continue();
+    };
+    req.onerror = function() {
+      console.error('failed to enumerate ' + aType + ' ' + req.error.name);
+      delete cursors[token];
+      delete win.gaiaFileCursorTimes[token];
+      callback(false);
+    };
+    if (aToken) {
+      // resume after the last file of the previous page
+      req.continue();
+    }
+  },
+
+  // Drops the cursor of an enumeration given up before its end.
+  closeFilesPage: function(aToken) {
+    delete this._fileCursors()[aToken];
+    delete window.wrappedJSObject.gaiaFileCursorTimes[aToken];
+  },
+
+  FILE_CURSOR_TTL: 60000,
+
+  // The open getFilesPage cursors by token, without the expired ones. They
+  // live on the window as every call runs in a new sandbox; the times they
+  // were last used are kept next to them in gaiaFileCursorTimes.
+  _fileCursors: function() {
+    var win = window.wrappedJSObject;
+    var cursors = win.gaiaFileCursors ||
+                  (win.gaiaFileCursors = new win.Object());
+    var times = win.gaiaFileCursorTimes ||
+                (win.gaiaFileCursorTimes = new win.Object());
+    var now = Date.now();
+    Object.keys(times).forEach(function(aToken) {
+      if (now - times[aToken] > this.FILE_CURSOR_TTL) {
+        delete cursors[aToken];
+        delete times[aToken];
+      }
+    }, this);
+    return cursors;
+  },
+
+  // Returns {type: {count, bytes}} for every storage type in one call.
+  getStorageSummary: function(aTypes, aCallback) {
+    var callback = aCallback || marionetteScriptFinished;
+    var summary = {};
+    var pending = aTypes.length;
+    if (!pending) {
+      callback(summary);
+      return;
+    }
+    aTypes.forEach(function(aType) {
+      var count = 0;
+      var bytes = 0;
+      var req = navigator.getDeviceStorage(aType).enumerate();
+      var finish = function(aResult) {
+        summary[aType] = aResult;
+        if (--pending === 0) {
+          callback(summary);
+        }
+      };
+      req.onsuccess = function() {
+        var file = req.result;
+        if (!file) {
+          finish({count: count, bytes: bytes});
+          return;
+        }
+        if (!(aType === 'music' && file.name.slice(-4) === '.3gp')) {
+          count++;
+          bytes += file.size;
+        }
+        req.continue();
+      };
+      req.onerror = function() {
+        console.error('failed to enumerate ' + aType + ' ' + req.error.name);
+        finish(null);
+      };
+    });
+  },
+
+  _readProcFile: function(aPath) {
+    var file = Components.classes['@mozilla.org/file/local;1']
+      .createInstance(Components.interfaces.nsIFile);
+    file.initWithPath(aPath);
+    var stream = Components.classes[
+      '@mozilla.org/network/file-input-stream;1']
+      .createInstance(Components.interfaces.nsIFileInputStream);
+    var text = '';
+    try {
+      stream.init(file, -1, 0, 0);
+      // /proc files report a size of 0 and nothing available(), so read
+      // through a converter stream, which reads the file until the end
+      // rather than what available() promises
+      var input = Components.classes[
+        '@mozilla.org/intl/converter-input-stream;1']
+        .createInstance(Components.interfaces.nsIConverterInputStream);
+      input.init(stream, 'UTF-8', 4096, 0);
+      var data = {};
+      while (input.readString(4096, data)) {
+        text += data.value;
+      }
+    } catch (e) {
+      // the process went away meanwhile
+      return null;
+    } finally {
+      stream.close();
+    }
+    return text;
+  },
+
+  // Returns the memory of the device in kB: system /proc/meminfo fields,
+  // resident and private (resident - shared) memory of b2g and of every
+  // process it started (apps are named after the app), and the explicit
+  // allocations reported by the parent. Must run in the chrome context.
+  getMemoryStats: function() {
+    var self = this;
+    var meminfo = {};
+    (this._readProcFile('/proc/meminfo') || '').split('\n').forEach(
+      function(aLine) {
+        var match = /^(\w+):\s+(\d+)/.exec(aLine);
+        if (match) {
+          meminfo[match[1]] = parseInt(match[2], 10);
+        }
+      });
+
+    var pageKb = 4;
+    var processes = [];
+    var entries = Components.classes['@mozilla.org/file/local;1']
+      .createInstance(Components.interfaces.nsIFile);
+    entries.initWithPath('/proc');
+    entries = entries.directoryEntries;
+    while (entries.hasMoreElements()) {
+      var pid = entries.getNext()
+        .QueryInterface(Components.interfaces.nsIFile).leafName;
+      if (!/^\d+$/.test(pid)) {
+        continue;
+      }
+      var stat = self._readProcFile('/proc/' + pid + '/stat');
+      if (!stat) {
+        continue;
+      }
+      // pid (name) state ppid ...
+      var name = stat.slice(stat.indexOf('(') + 1, stat.lastIndexOf(')'));
+      var ppid = parseInt(stat.slice(stat.lastIndexOf(')') + 2).split(' ')[1],
+                          10);
+      processes.push({pid: parseInt(pid, 10), ppid: ppid, name: name});
+    }
+    var parents = processes.filter(function(aProcess) {
+      return aProcess.name === 'b2g';
+    }).map(function(aProcess) { return aProcess.pid; });
+    processes = processes.filter(function(aProcess) {
+      return parents.indexOf(aProcess.pid) > -1 ||
+             parents.indexOf(aProcess.ppid) > -1;
+    });
+    // memory is only read for b2g and its children, smaps is long
+    processes.forEach(function(aProcess) {
+      var statm = self._readProcFile('/proc/' + aProcess.pid + '/statm');
+      aProcess.rss = statm ? parseInt(statm.split(' ')[1], 10) * pageKb : null;
+      // uss is the sum of the pages mapped by this process only
+      var smaps = self._readProcFile('/proc/' + aProcess.pid + '/smaps');
+      aProcess.uss = smaps ? 0 : null;
+      var privateLine = /^Private_(?:Clean|Dirty):\s+(\d+) kB/gm;
+      var match;
+      while (smaps && (match = privateLine.exec(smaps))) {
+        aProcess.uss += parseInt(match[1], 10);
+      }
+    });
+
+    var explicit = null;
+    try {
+      explicit = Components.classes[
+        '@mozilla.org/memory-reporter-manager;1']
+        .getService(Components.interfaces.nsIMemoryReporterManager)
+        .explicit / 1024;
+    } catch (e) {
+      // not implemented on every build
+    }
+    return {meminfo: meminfo, processes: processes, explicit: explicit};
+  },
+
+  // Writes base64 chunks ({name, data, append}) to storage aType, all at
+  // once; a chunk without append replaces the file. Chunks of one call must
+  // belong to different files.
+  writeFileChunks: function(aType, aChunks, aCallback) {
+    var callback = aCallback || marionetteScriptFinished;
+    var self = this;
+    var storage = navigator.getDeviceStorage(aType);
+    this._inParallel(aChunks, function(aChunk, aDone) {
+      var blob = self.base64ToBlob(aChunk.data, 'application/octet-stream');
+      var write = function() {
+        var req = aChunk.append ? storage.appendNamed(blob, aChunk.name) :
+                                  storage.addNamed(blob, aChunk.name);
+        req.onsuccess = function() {
+          aDone(true);
+        };
+        req.onerror = function() {
+          console.error('failed to write ' + aChunk.name + ' ' +
+                        req.error.name);
+          aDone(false);
+        };
+      };
+      if (aChunk.append) {
+        write();
+        return;
+      }
+      // addNamed refuses to overwrite, so drop any previous version first
+      var del = storage.delete(aChunk.name);
+      del.onsuccess = del.onerror = write;
+    }, aChunks.length, 'written', Date.now(), function(aResults) {
+      callback(aResults.every(function(aSuccess) { return aSuccess; }));
+    });
+  },
+
+  // Reads byte ranges ({name, offset, length}) of files in storage aType, all
+  // at once. Returns a {size, data} per request with the data base64 encoded,
+  // or null for files that can't be read.
+  readFileChunks: function(aType, aRequests, aCallback) {
+    var callback = aCallback || marionetteScriptFinished;
+    var storage = navigator.getDeviceStorage(aType);
+    this._inParallel(aRequests, function(aRequest, aDone) {
+      var req = storage.get(aRequest.name);
+      req.onsuccess = function() {
+        var file = req.result;
+        var reader = new FileReader();
+        reader.onloadend = function() {
+          var url = reader.result || '';
+          aDone({size: file.size, data: url.slice(url.indexOf(',') + 1)});
+        };
+        reader.readAsDataURL(
+          file.slice(aRequest.offset, aRequest.offset + aRequest.length));
+      };
+      req.onerror = function() {
+        console.error('failed to read ' + aRequest.name + ' ' + req.error.name);
+        aDone(null);
+      };
+    }, aRequests.length, 'read', Date.now(), callback);
+  },
+
+  // Returns {name: hex sha-256 or null} for files in storage aType. Files
+  // larger than aMaxSize bytes are not read, crypto.subtle.digest needs the
+  // whole file in memory, they get {size, lastModified} instead.
+  getFileDigests: function(aType, aNames, aMaxSize, aCallback) {
+    var callback = aCallback || marionetteScriptFinished;
+    var storage = navigator.getDeviceStorage(aType);
+    var digests = {};
+    this._inParallel(aNames, function(aName, aDone) {
+      var req = storage.get(aName);
+      req.onsuccess = function() {
+        var file = req.result;
+        if (aMaxSize && file.size > aMaxSize) {
+          digests[aName] = {'size': file.size, 'lastModified': file.lastModified};
+          aDone();
+          return;
+        }
+        var reader = new FileReader();
+        reader.onloadend = function() {
+          if (reader.error) {
+            console.error('failed to read ' + aName + ' ' + reader.error.name);
+            digests[aName] = null;
+            aDone();
+            return;
+          }
+          window.crypto.subtle.digest('SHA-256', reader.result).then(
+            function(aDigest) {
+              digests[aName] = Array.prototype.map.call(
+                new Uint8Array(aDigest), function(aByte) {
+                  return ('0' + aByte.toString(16)).slice(-2);
+                }).join('');
+            }).catch(function(aError) {
+              console.error('failed to hash ' + aName + ' ' + aError);
+              digests[aName] = null;
+            }).then(function() {
+              aDone();
+            });
+        };
+        reader.readAsArrayBuffer(file);
+      };
+      req.onerror = function() {
+        digests[aName] = null;
+        aDone();
+      };
+    }, 4, 'hashed', Date.now(), function() {
+      callback(digests);
+    });
+  },
+
   sendSMS: function(recipient, content, skipVerification, aCallback) {
     // requires the 'sms' permission and the 'dom.sms.enabled' pref
     var callback = aCallback || marionetteScriptFinished;
@@ -598,13 +1325,27 @@ var GaiaDataLayer = {
 
     request.onsuccess = function(event) {
       var sms = event.target.result;
+      var sent = false;
+      // the 'sent' event carries the updated message, the object returned by
+      // the request keeps the delivery state it had when it was created
+      var onSent = function(aEvent) {
+        if (aEvent.message && aEvent.message.id === sms.id) {
+          sent = true;
+        }
+      };
+      messageManager.addEventListener('sent', onSent);
 
       waitFor(
-        function() { callback(true); },
+        function() {
+          messageManager.removeEventListener('sent', onSent);
+          callback(true);
+        },
         function() {
           console.log('sms delivery state: ' + sms.delivery);
-          return sms.delivery === 'sent';
-        }
+          return sent || sms.delivery === 'sent';
+        },
+        undefined,
+        { events: [[messageManager, 'sent']] }
       );
     };
 
@@ -642,6 +1383,88 @@ var GaiaDataLayer = {
     };
   },
 
+  // Returns up to aPageSize messages reduced to aFields, starting after
+  // aToken, as {messages, token}. Pass the returned token to get the next
+  // page; it is null once all messages have been returned. Messages are
+  // walked in timestamp order, the token remembers the last timestamp and the
+  // ids already returned with it.
+  getSmsPage: function(aFields, aPageSize, aToken, aCallback) {
+    // requires the 'sms' permission and the 'dom.sms.enabled' pref
+    var callback = aCallback || marionetteScriptFinished;
+    var sms = window.navigator.mozMobileMessage;
+    var filter = aToken ? {startDate: new Date(aToken.timestamp)} : null;
+    var cursor = sms.getMessages(filter, false);
+    var messages = [];
+    var lastTimestamp = aToken ? aToken.timestamp : null;
+    var lastIds = aToken ? aToken.ids.slice() : [];
+
+    cursor.onsuccess = function() {
+      var message = cursor.result;
+      if (!message) {
+        callback({messages: messages, token: null});
+        return;
+      }
+      var timestamp = +message.timestamp;
+      if (timestamp === lastTimestamp && lastIds.indexOf(message.id) > -1) {
+        cursor.continue();
+        return;
+      }
+      var result = {};
+      aFields.forEach(function(aField) {
+        result[aField] = aField === 'timestamp' ? timestamp : message[aField];
+      });
+      messages.push(result);
+      if (timestamp !== lastTimestamp) {
+        lastTimestamp = timestamp;
+        lastIds = [];
+      }
+      lastIds.push(message.id);
+
+      if (messages.length >= aPageSize) {
+        callback({messages: messages,
+                  token: {timestamp: lastTimestamp, ids: lastIds}});
+      } else {
+        cursor.continue();
+      }
+    };
+
+    cursor.onerror = function(event) {
+      console.log('sms.getMessages error: ' + event.target.error.name);
+      callback(false);
+    };
+  },
+
+  // Stores received messages ({sender, body, timestamp}) straight in the
+  // message database without a radio, so they show up in the Messages app
+  // grouped into one thread per sender. Must run in the chrome context.
+  insertSms: function(aMessages, aConcurrency, aCallback) {
+    var callback = aCallback || marionetteScriptFinished;
+    var db = Components.classes[
+      '@mozilla.org/mobilemessage/rilmobilemessagedatabaseservice;1']
+      .getService(Components.interfaces.nsIRilMobileMessageDatabaseService);
+    var start = Date.now();
+    this._inParallel(aMessages, function(aMessage, aDone) {
+      var timestamp = aMessage.timestamp || Date.now();
+      db.saveReceivedMessage({
+        type: 'sms',
+        sender: aMessage.sender,
+        body: aMessage.body,
+        messageClass: 'normal',
+        timestamp: timestamp,
+        sentTimestamp: timestamp,
+        iccId: null
+      }, {
+        notify: function(aRv, aDomMessage) {
+          aDone(Components.isSuccessCode(aRv) ? aDomMessage.id : null);
+        }
+      });
+    }, aConcurrency, 'stored', start, function(aIds) {
+      callback({ids: aIds,
+                failed: aIds.filter(function(aId) { return !aId; }).length,
+                seconds: (Date.now() - start) / 1000});
+    });
+  },
+
   deleteAllSms: function(aCallback) {
     // requires the 'sms' permission and the 'dom.sms.enabled' pref
     var callback = aCallback || marionetteScriptFinished;
@@ -676,20 +1499,15 @@ var GaiaDataLayer = {
     };
 
     function deleteSmsMsgs(msgList) {
-      let smsId = msgList.shift();
-      console.log('deleting sms id: ' + smsId);
-      let request = sms.delete(smsId);
+      // mozMobileMessage.delete takes all the ids at once and answers with
+      // one result per id
+      let request = sms.delete(msgList);
 
       request.onsuccess = function(event) {
-        if (event.target.result) {
-          // Message deleted, continue until none are left
-          if (msgList.length) {
-            deleteSmsMsgs(msgList);
-          } else {
-            // All messages deleted
-            console.log('finished deleting all sms messages');
-            callback(true);
-          }
+        let results = [].concat(event.target.result);
+        if (results.every(function(deleted) { return deleted; })) {
+          console.log('finished deleting all sms messages');
+          callback(true);
         } else {
           console.log('sms delete failed');
           callback(false);
@@ -0,0 +1,101 @@
+/* This Source Code Form is subject to the terms of the Mozilla Public
+ * License, v. 2.0. If a copy of the MPL was not distributed with this file,
+ * You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+'use strict';
+/* globals marionetteScriptFinished */
+/* exported GaiaKeys */
+
+var GaiaKeys = {
+
+  // polling interval (ms) of selector waits
+  waitInterval: 50,
+
+  press: function(aKey) {
+    let win = window.wrappedJSObject;
+    win.dispatchEvent(new KeyboardEvent('keydown', { key: aKey }));
+    win.dispatchEvent(new KeyboardEvent('keyup', { key: aKey }));
+  },
+
+  /**
+   * Plays steps in order in the current frame and finishes with the number
+   * of keys pressed, or with {error, step} when a wait times out.
+   *
+   * A step is {key, count, delay}: count presses of key each followed by
+   * delay ms, {sleep: ms}, or {selector, timeout}: waits up to timeout ms for
+   * an element matching selector.
+   */
+  play: function(aSteps) {
+    let pressed = 0;
+    let index = 0;
+
+    let next = function() {
+      if (index >= aSteps.length) {
+        marionetteScriptFinished({ pressed: pressed });
+        return;
+      }
+      let step = aSteps[index++];
+      if (step.key) {
+        let count = step.count || 1;
+        let repeat = function() {
+          GaiaKeys.press(step.key);
+          pressed++;
+          count--;
+          window.setTimeout(count ? repeat : next, step.delay || 0);
+        };
+        repeat();
+      } else if (step.sleep) {
+        window.setTimeout(next, step.sleep);
+      } else {
+        let deadline = Date.now() + step.timeout;
+        let check = function() {
+          if (document.querySelector(step.selector)) {
+            next();
+          } else if (Date.now() > deadline) {
+            marionetteScriptFinished({
+              error: 'timed out waiting for ' + step.selector,
+              step: index - 1,
+              pressed: pressed
+            });
+          } else {
+            window.setTimeout(check, GaiaKeys.waitInterval);
+          }
+        };
+        check();
+      }
+    };
+    next();
+  },
+
+  /**
+   * Records the keys pressed on the device for aDuration ms, run from the
+   * system frame. Finishes with [key, ms since the previous key] pairs.
+   */
+  record: function(aDuration) {
+    let keys = [];
+    let last = Date.now();
+    // a key going to an app shows up as mozbrowserbeforekeydown, one handled
+    // by the system app itself as keydown
+    let types = ['keydown', 'mozbrowserbeforekeydown'];
+
+    let listener = function(aEvent) {
+      let now = Date.now();
+      let previous = keys[keys.length - 1];
+      if (previous && previous[0] === aEvent.key && now - last < 5) {
+        return;
+      }
+      keys.push([aEvent.key, now - last]);
+      last = now;
+    };
+
+    types.forEach(function(aType) {
+      window.addEventListener(aType, listener, true);
+    });
+    window.setTimeout(function() {
+      types.forEach(function(aType) {
+        window.removeEventListener(aType, listener, true);
+      });
+      marionetteScriptFinished(keys);
+    }, aDuration);
+  }
+};
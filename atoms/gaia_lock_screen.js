@@ -16,15 +16,17 @@ var GaiaLockScreen = {
 
     waitFor(
       function() {
-        service.request('unlock', { forcibly: forcibly });
         waitFor(
           function() {
             finish(service.query("locked"));
           },
           function() {
             return !service.query("locked");
-          }
+          },
+          undefined,
+          { events: [[window, 'lockscreen-appclosed']] }
         );
+        service.request('unlock', { forcibly: forcibly });
       },
       function() {
         return !!service;
@@ -39,15 +41,17 @@ var GaiaLockScreen = {
     setlock.set(obj);
     waitFor(
       function() {
-      service.request('lock', { forcibly: forcibly });
         waitFor(
           function() {
             finish(!service.query("locked"));
           },
           function() {
             return service.query("locked");
-          }
+          },
+          undefined,
+          { events: [[window, 'lockscreen-appopened']] }
         );
+        service.request('lock', { forcibly: forcibly });
       },
       function() {
         return !!service;
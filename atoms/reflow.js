@@ -7,29 +7,51 @@
 
   exports.MozReflowAtom = {
     count: null,
+    samples: null,
     _trackingManifest: null,
+    _startTime: null,
 
     init: function rw_init() {
       exports.addEventListener('developer-hud-update', this);
     },
 
     handleEvent: function rw_handleEvent(evt) {
-      var metric = evt.detail.metric.name || evt.detail.metric;
-      if (metric !== 'reflows' ||
+      if (!this._trackingManifest ||
           evt.detail.manifest !== this._trackingManifest) {
         return;
       }
+      var metric = evt.detail.metric.name || evt.detail.metric;
+      // every other developer HUD metric (jank, memory, fps...) is kept as a
+      // timestamped sample next to the reflow count
+      this.samples.push({
+        time: Date.now() - this._startTime,
+        name: metric,
+        value: evt.detail.metric.value === undefined ?
+          null : evt.detail.metric.value
+      });
+      if (metric !== 'reflows') {
+        return;
+      }
       this.count++;
     },
 
     startTracking: function(manifestURL) {
       this._trackingManifest = manifestURL;
+      this._startTime = Date.now();
       this.count = 0;
+      this.samples = [];
     },
 
     stopTracking: function() {
+      var result = {
+        count: this.count,
+        samples: this.samples,
+        duration: Date.now() - this._startTime
+      };
       this.count = 0;
+      this.samples = null;
       this._trackingManifest = null;
+      return result;
     },
   };
 
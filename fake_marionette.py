@@ -0,0 +1,411 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""A local stand-in for the marionette server of a B2G device.
+
+Speaks marionette protocol level 3 (len:json framing, [0, id, name, params]
+commands, [1, id, error, result] replies) and answers the scripts gaia.py
+sends with canned replies computed from a small FakeB2G state, so commands
+and host side benchmarks run without a handset:
+
+    python fake_marionette.py [--port 2828] [--latency 0.05] [--config fake.json]
+
+The optional json config holds
+    {"latency": {"executeAsyncScript": 0.2},
+     "scripts": [["GaiaApps.getDisplayedApp", {"name": "Clock"}]],
+     "errors": [["GaiaLockScreen.unlock", "unable to unlock"]],
+     "settings": {"language.current": "en-US"}, "prefs": {"dom.mozApps.debug": true}}
+where scripts and errors are (substring of the script, reply) pairs checked
+in order before the built-in replies.
+"""
+
+import base64
+import itertools
+import json
+import os
+import re
+import socket
+import SocketServer
+import struct
+import sys
+import threading
+import time
+import zlib
+
+PROTOCOL = 3
+HELLO = {'applicationType': 'gecko', 'marionetteProtocol': PROTOCOL}
+CAPABILITIES = {'browserName': 'B2G', 'platformName': 'B2G', 'device': 'fake', 'b2g': True}
+# (name, origin, role) of the apps FakeB2G starts with, the first one is displayed
+DEFAULT_APPS = (('Homescreen', 'app://homescreen.gaiamobile.org', 'homescreen'),
+                ('Camera', 'app://camera.gaiamobile.org', None),
+                ('Clock', 'app://clock.gaiamobile.org', None),
+                ('Music', 'app://music.gaiamobile.org', None),
+                ('Settings', 'app://settings.gaiamobile.org', None),
+                ('Contacts', 'app://communications.gaiamobile.org', None))
+# globals the atoms define, scripts using one before its atom was imported fail
+ATOM_GLOBALS = ('GaiaApps', 'waitFor', 'GaiaDataLayer', 'GaiaLockScreen', 'Accessibility', 'MozReflowAtom',
+                'GaiaKeys')
+DEFAULT_SETTINGS = {'language.current': 'en-US', 'screen.brightness': 1.0, 'lockscreen.enabled': False}
+SCREEN_SIZE = (320, 480)
+
+
+class FakeScriptError(Exception):
+    """Answered as a marionette error instead of a script result."""
+
+    def __init__(self, message, error='javascript error'):
+        Exception.__init__(self, message)
+        self.error = error
+
+
+def call_arguments(script, function):
+    """The literal arguments of the first call of function in script, e.g. GaiaApps.kill('app://x')."""
+    match = re.search(re.escape(function) + r'\((.*)\)', script)
+    if not match:
+        return []
+    try:
+        return json.loads('[%s]' % match.group(1))
+    except ValueError:
+        # gaia.py quotes some arguments with '
+        return json.loads('[%s]' % match.group(1).replace("'", '"'))
+
+
+def png_data(width, height, seed=os.urandom):
+    """A width x height RGBA png of noise, compressing about as badly as a busy screen."""
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+    row = width * 4
+    pixels = seed(row * height)
+    raw = ''.join('\0' + pixels[y * row:(y + 1) * row] for y in xrange(height))
+    return ('\x89PNG\r\n\x1a\n' +
+            chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)) +
+            chunk('IDAT', zlib.compress(raw, 1)) + chunk('IEND', ''))
+
+
+def jpeg_data(width, height):
+    """A width x height baseline jpeg of flat grey, each 8x8 block coded in two bits."""
+    def segment(marker, data):
+        return '\xff' + marker + struct.pack('>H', len(data) + 2) + data
+    # one-symbol huffman tables: DC difference 0 and end of block, both coded as a 0 bit
+    table = chr(1) + '\0' * 15 + '\0'
+    bits = ((width + 7) // 8) * ((height + 7) // 8) * 2
+    scan = '\0' * (bits // 8) + (chr(0xff >> (bits % 8)) if bits % 8 else '')
+    return ('\xff\xd8' +
+            segment('\xdb', '\0' + '\x01' * 64) +
+            segment('\xc0', struct.pack('>BHHB', 8, height, width, 1) + '\x01\x11\0') +
+            segment('\xc4', '\x00' + table) + segment('\xc4', '\x10' + table) +
+            segment('\xda', '\x01\x01\x00\x00\x3f\x00') + scan + '\xff\xd9')
+
+
+class FakeB2G(object):
+    """Device state behind FakeMarionetteServer and the replies to gaia's scripts.
+
+    scripts and errors are lists of (substring, reply) checked in order
+    before the built-in replies; a reply may be a callable taking the script
+    and its arguments.
+    """
+
+    def __init__(self, apps=DEFAULT_APPS, settings=None, prefs=None, screen=SCREEN_SIZE):
+        self.apps = [self._app(name, origin, role) for name, origin, role in apps]
+        self.generation = 1
+        self.settings = dict(DEFAULT_SETTINGS, **(settings or {}))
+        self.prefs = dict(prefs or {})
+        self.screen = screen
+        self.displayed = self.apps[0]
+        self.running = {}
+        self.scripts = []
+        self.errors = []
+        self._frames = {}
+        self._screenshots = {}
+        self._lock = threading.Lock()
+        # built-in replies, the first matching substring wins
+        self.replies = [
+            ('GaiaApps.getAppIndexGeneration', lambda script, args: self.generation),
+            ('GaiaApps.getAppIndex', self.app_index),
+            ('GaiaApps.launchWithManifestURL', self.launch),
+            ('GaiaApps.getDisplayedApp', lambda script, args: self.frame(self.displayed)),
+            ('GaiaApps.getRunningApps', self.running_apps),
+            ('GaiaApps.killAll', self.kill_all),
+            ('GaiaApps.kill', self.kill),
+            ('GaiaApps.waitForSystemReady', lambda script, args: {'homescreen': 0, 'logo': 0}),
+            ('GaiaDataLayer.getSettings', self.get_settings),
+            ('GaiaDataLayer.setSettings', self.set_settings),
+            ('GaiaDataLayer.getSetting', self.get_setting),
+            ('GaiaDataLayer.setSetting', self.set_setting),
+            ('GaiaDataLayer.getMemoryStats', self.memory_stats),
+            # Marionette.get_pref/set_pref/clear_pref
+            ('Services.prefs.getPrefType', lambda script, args: self.prefs.get(args[0])),
+            ('Services.prefs.clearUserPref', lambda script, args: self.prefs.pop(args[0], None)),
+            ('Services.prefs.set', lambda script, args: self.prefs.__setitem__(args[0], args[1])),
+            ('SpecialPowers.get', self.get_pref),
+            ('SpecialPowers.set', self.set_pref),
+            ('GaiaKeys.play', lambda script, args: {'pressed': sum(step.get('count', 1) for step in args[0]
+                                                                   if step.get('key'))}),
+            ('GaiaKeys.record', lambda script, args: []),
+            ('GaiaLockScreen.unlock', lambda script, args: True),
+            # system events of touch_home_button/press_keys
+            ('dispatchEvent(new Event(', self.system_events),
+            # no element of the fake device has an accessible
+            ('Accessibility.describe', lambda script, args: {'result': [
+                {'accessible': False, 'name': None, 'role': None, 'states': [],
+                 'hidden': True, 'visible': False, 'disabled': None} for element in args[0] or []]}),
+            ('function takeScreenshot', self.screenshot),
+            ('ScreenManager.screenEnabled', lambda script, args: True),
+            ('Service.locked', lambda script, args: False),
+            ('window.screen.width', lambda script, args: self.screen[0]),
+            ('window.screen.mozOrientation', lambda script, args: 'portrait-primary'),
+            # the homescreen is always scrolled to the top
+            ('window.wrappedJSObject.scrollY', lambda script, args: 0),
+        ]
+
+    @staticmethod
+    def _app(name, origin, role):
+        normalized = re.sub('[- ]+', '', name).lower()
+        return {'manifestURL': origin + '/manifest.webapp', 'origin': origin, 'entryPoint': None,
+                'appName': name, 'name': normalized, 'role': role, 'names': [normalized]}
+
+    def install(self, name, origin, role=None):
+        """Adds an app the way mozApps would, outdating app indexes built before."""
+        with self._lock:
+            self.apps.append(self._app(name, origin, role))
+            self.generation += 1
+
+    def reply(self, script, args):
+        """The result of running script with args; raises FakeScriptError for configured errors."""
+        for pattern, message in self.errors:
+            if pattern in script:
+                raise FakeScriptError(message)
+        for pattern, reply in self.scripts + self.replies:
+            if pattern in script:
+                with self._lock:
+                    return reply(script, args) if callable(reply) else reply
+        return None
+
+    def frame(self, app):
+        if app['origin'] not in self._frames:
+            self._frames[app['origin']] = 'frame-%d' % (len(self._frames) + 1)
+        return {'frame': {'ELEMENT': self._frames[app['origin']]}, 'src': app['origin'] + '/index.html',
+                'name': app['appName'], 'origin': app['origin']}
+
+    def app_index(self, script, args):
+        return {'generation': self.generation, 'apps': self.apps}
+
+    def launch(self, script, args):
+        arguments = call_arguments(script, 'GaiaApps.launchWithManifestURL')
+        if len(arguments) > 2 and arguments[2] != self.generation:
+            return {'stale': True}
+        for app in self.apps:
+            if app['manifestURL'] == arguments[0]:
+                self.displayed = self.running[app['origin']] = app
+                return self.frame(app)
+        return False
+
+    def running_apps(self, script, args):
+        return dict((origin, {'name': app['appName'], 'origin': origin, 'manifest': {}})
+                    for origin, app in self.running.items())
+
+    def kill(self, script, args):
+        app = self.running.pop(call_arguments(script, 'GaiaApps.kill')[0], None)
+        if app is self.displayed:
+            self.displayed = self.apps[0]
+        return app is not None
+
+    def kill_all(self, script, args):
+        self.running.clear()
+        self.displayed = self.apps[0]
+        return True
+
+    def system_events(self, script, args):
+        """The home button brings the homescreen back to the front."""
+        names = re.findall(r"new Event\('(\w+)'\)", script) or (args[0] if args else [])
+        if 'home' in names:
+            self.displayed = self.apps[0]
+
+    def get_settings(self, script, args):
+        # like mozSettings, settings never set are left out
+        return dict((name, self.settings[name]) for name in call_arguments(script, 'GaiaDataLayer.getSettings')[0]
+                    if name in self.settings)
+
+    def set_settings(self, script, args):
+        values = call_arguments(script, 'GaiaDataLayer.setSettings')[0]
+        self.settings.update(values)
+        return dict((name, self.settings[name]) for name in values)
+
+    def get_setting(self, script, args):
+        name = call_arguments(script, 'GaiaDataLayer.getSetting')[0]
+        return dict(self.settings) if name == '*' else self.settings.get(name)
+
+    def set_setting(self, script, args):
+        name, value = call_arguments(script, 'GaiaDataLayer.setSetting')
+        self.settings[name] = value
+        return True
+
+    def get_pref(self, script, args):
+        return self.prefs.get(re.search(r"Pref\('(.*)'\)", script).group(1))
+
+    def set_pref(self, script, args):
+        name, value = re.search(r"Pref\('(.*)', (.*)\)", script).groups()
+        self.prefs[name] = json.loads(value)
+
+    def memory_stats(self, script, args):
+        processes = [{'pid': 1, 'ppid': 0, 'name': 'b2g', 'rss': 90000, 'uss': 80000}]
+        processes += [{'pid': index + 2, 'ppid': 1, 'name': app['appName'], 'rss': 30000, 'uss': 20000}
+                      for index, app in enumerate(self.running.values())]
+        return {'meminfo': {'MemTotal': 512000, 'MemFree': 128000, 'Buffers': 16000, 'Cached': 64000},
+                'processes': processes, 'explicit': 60000}
+
+    def screenshot(self, script, args):
+        """A data url of the (region of the) screen in the requested format."""
+        format, quality, region, scale = (list(args) + [None] * 4)[:4]
+        width, height = region[2:] if region else self.screen
+        width, height = int(round(width * (scale or 1))), int(round(height * (scale or 1)))
+        key = (format, width, height)
+        if key not in self._screenshots:
+            if format == 'raw':
+                self._screenshots[key] = 'data:image/x-rgba;width=%d;height=%d;base64,%s' % (
+                    width, height, base64.b64encode(os.urandom(width * height * 4)))
+            elif format == 'jpeg':
+                self._screenshots[key] = 'data:image/jpeg;base64,' + base64.b64encode(jpeg_data(width, height))
+            else:
+                self._screenshots[key] = 'data:image/png;base64,' + base64.b64encode(png_data(width, height))
+        return self._screenshots[key]
+
+
+class FakeMarionetteHandler(SocketServer.StreamRequestHandler):
+    """One client connection: the hello, then a reply per command until it disconnects."""
+
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # context and imported globals belong to the session of this connection
+        session = {'context': 'content', 'imports': {}}
+        try:
+            self.send(HELLO)
+            for msgid, name, params in iter(self.receive, None):
+                self.server.wait(name)
+                try:
+                    self.send([1, msgid, None, self.server.respond(name, params, session)])
+                except FakeScriptError as e:
+                    self.send([1, msgid, {'error': e.error, 'message': str(e), 'stacktrace': None}, None])
+                except Exception as e:
+                    self.send([1, msgid, {'error': 'unknown error', 'message': "%s: %s" % (type(e).__name__, e),
+                                          'stacktrace': None}, None])
+        except socket.error:
+            # wait_for_port probes hang up right after the hello
+            pass
+
+    def receive(self):
+        """(id, name, params) of the next command, None once the client disconnected."""
+        length = ''
+        while not length.endswith(':'):
+            byte = self.rfile.read(1)
+            if not byte:
+                return None
+            length += byte
+        command = json.loads(self.rfile.read(int(length[:-1])))
+        return command[1], command[2], command[3] or {}
+
+    def send(self, obj):
+        data = json.dumps(obj)
+        self.wfile.write('%d:%s' % (len(data), data))
+        self.wfile.flush()
+
+
+class FakeMarionetteServer(SocketServer.ThreadingTCPServer):
+    """Serves FakeB2G over the marionette protocol on host:port (0 picks a free port).
+
+    latency delays every reply by that many seconds, a dict gives it per
+    command name with 'default' for the others. commands counts the
+    commands received by name. Like on a device, the globals of imported
+    scripts are only defined in the context they were imported into and
+    until the next session of that connection.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='localhost', port=2828, device=None, latency=0.0):
+        SocketServer.ThreadingTCPServer.__init__(self, (host, port), FakeMarionetteHandler)
+        self.device = device or FakeB2G()
+        self.latency = latency if isinstance(latency, dict) else {'default': latency}
+        self.commands = {}
+        self._sessions = itertools.count(1)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        """Serves from a daemon thread, returns self once it accepts connections."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def wait(self, name):
+        delay = self.latency.get(name, self.latency.get('default', 0))
+        if delay:
+            time.sleep(delay)
+
+    def respond(self, name, params, session):
+        self.commands[name] = self.commands.get(name, 0) + 1
+        if name == 'newSession':
+            session.update(context='content', imports={})
+            return {'sessionId': params.get('sessionId') or 'fake-%d' % next(self._sessions),
+                    'capabilities': CAPABILITIES}
+        if name in ('executeScript', 'executeAsyncScript'):
+            return {'value': self.execute(params['script'], params.get('args') or [], session)}
+        if name == 'importScript':
+            # var GaiaApps = ..., function waitFor(...) or exports.MozReflowAtom = ...
+            session['imports'].setdefault(session['context'], set()).update(
+                re.findall(r'^\s*(?:var |function |exports\.)(\w+)', params['script'], re.M))
+        elif name == 'setContext':
+            session['context'] = params['value']
+        elif name == 'getContext':
+            return {'value': session['context']}
+        elif name == 'findElement':
+            return {'value': {'ELEMENT': 'element-1'}}
+        elif name == 'findElements':
+            return [{'ELEMENT': 'element-1'}]
+        # deleteSession, switchToFrame, timeouts, ...
+        return {'value': None}
+
+    def execute(self, script, args, session):
+        defined = session['imports'].get(session['context'], set())
+        for symbol in ATOM_GLOBALS:
+            if symbol not in defined and re.search(r'\b%s\b' % symbol, script):
+                raise FakeScriptError('ReferenceError: %s is not defined' % symbol)
+        return self.device.reply(script, args)
+
+
+def load_config(path):
+    """Server keyword arguments from a json config, see the module docstring."""
+    with open(path) as f:
+        config = json.load(f)
+    device = FakeB2G(settings=config.get('settings'), prefs=config.get('prefs'))
+    device.scripts = [tuple(pair) for pair in config.get('scripts', [])]
+    device.errors = [tuple(pair) for pair in config.get('errors', [])]
+    return {'device': device, 'latency': config.get('latency', 0.0)}
+
+
+def main(argv):
+    options = dict((key.lstrip('-'), value) for key, value in zip(argv[1::2], argv[2::2]))
+    kwargs = load_config(options['config']) if options.get('config') else {}
+    if options.get('latency'):
+        kwargs['latency'] = float(options['latency'])
+    server = FakeMarionetteServer(port=int(options.get('port') or 2828), **kwargs)
+    print "fake marionette listening on port %d" % server.port
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -2,11 +2,314 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import base64
+import hashlib
+import itertools
 import json
 import os
+import Queue
+import re
+import shlex
 import shutil
+import socket
+import sys
 import tempfile
+import threading
 import time
+import weakref
+
+from concurrent.futures import ThreadPoolExecutor, wait as wait_for_futures
+from contextlib import contextmanager
+
+from marionette_driver import By, Wait
+from marionette_driver.errors import JavascriptException, TimeoutException
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, peak memory is then reported as None
+    resource = None
+
+# base64 characters decoded and written at a time by save_screenshot, multiple of 4
+SCREENSHOT_CHUNK_SIZE = 64 * 1024
+# contact removals kept in flight on the device by remove_all_contacts
+CONTACT_REMOVAL_CONCURRENCY = 8
+# contacts sent per round trip and saves kept in flight by insert_contacts
+CONTACT_CHUNK_SIZE = 200
+CONTACT_SAVE_CONCURRENCY = 8
+# message fields returned by get_all_sms and messages per round trip
+SMS_FIELDS = ('id', 'threadId', 'type', 'delivery', 'sender', 'receiver', 'body', 'timestamp', 'read')
+SMS_PAGE_SIZE = 500
+# files returned per round trip by iter_files
+FILES_PAGE_SIZE = 500
+MEDIA_STORAGE_TYPES = ('music', 'pictures', 'videos')
+# bytes per chunk and files moved side by side by push_files/pull_files
+FILE_CHUNK_SIZE = 256 * 1024
+FILE_TRANSFERS = 4
+# larger device files are compared on size and modification time, hashing reads them whole into memory
+FILE_DIGEST_MAX_SIZE = 16 * 1024 * 1024
+# messages sent per round trip and stores kept in flight by insert_sms
+SMS_CHUNK_SIZE = 500
+SMS_STORE_CONCURRENCY = 8
+# file extension of the frames written by ScreenRecorder
+SCREENSHOT_EXTENSIONS = {'png': '.png', 'jpeg': '.jpg', 'raw': '.rgba'}
+# settings left out of snapshots, they describe the device rather than its state
+SNAPSHOT_EXCLUDED_SETTINGS = ('deviceinfo.',)
+# growth per cycle (kB) from which SoakTest.trend flags a leak
+SOAK_LEAK_KB_PER_CYCLE = 100
+# seconds Accessibility.describe waits for the accessibles of all elements together
+ACCESSIBILITY_TIMEOUT = 5
+# ms after every key press of press_keys unless the step sets its own
+KEY_DELAY = 100
+# keys dispatched as events of the system app rather than as key presses
+SYSTEM_KEY_EVENTS = ('home', 'holdhome', 'holdsleep', 'volumeup', 'volumedown', 'holdstar', 'holdhash')
+# hardware keys as GaiaKeys.record sees them -> the system event press_button sends for them
+HARDWARE_KEY_EVENTS = {'Home': 'home', 'VolumeUp': 'volumeup', 'VolumeDown': 'volumedown'}
+
+
+ATOMS_PATH = os.path.abspath(os.path.join(__file__, os.path.pardir, 'atoms'))
+
+
+def payload_size(value):
+    """Approximate bytes of value on the wire."""
+    try:
+        return len(json.dumps(value))
+    except (TypeError, ValueError):
+        # web elements and other objects the client decoded
+        return len(repr(value))
+
+
+class CallProfiler(object):
+    """Records every marionette round trip made through AtomLoader while recording.
+
+    Recording is per thread, so each device of a fleet gets its own calls.
+    A call is a dict with the gaia method making it, the command, the bytes
+    sent and received, its start (s since the epoch) and duration in ms.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    @contextmanager
+    def recording(self):
+        calls = []
+        previous = getattr(self._local, 'calls', None)
+        self._local.calls = calls
+        try:
+            yield calls
+        finally:
+            self._local.calls = previous
+
+    def call(self, command, script, args, send):
+        """Returns send(), timing it when the current thread is recording."""
+        calls = getattr(self._local, 'calls', None)
+        if calls is None:
+            return send()
+        start = time.time()
+        try:
+            result = send()
+        finally:
+            calls.append({'caller': self.caller(),
+                          'command': command,
+                          'thread': threading.current_thread().name,
+                          'sent': len(script) + (payload_size(args) if args else 0),
+                          'received': 0,
+                          'start': start,
+                          'duration': (time.time() - start) * 1000})
+        calls[-1]['received'] = payload_size(result)
+        return result
+
+    @staticmethod
+    def caller():
+        """Name of the closest gaia method on the stack, else the closest function."""
+        frame = sys._getframe(2)
+        fallback = None
+        while frame:
+            code = frame.f_code
+            owner = frame.f_locals.get('self')
+            if not isinstance(owner, (AtomLoader, AtomRegistry, CallProfiler)) and code.co_name != '<lambda>':
+                name = '%s.%s' % (type(owner).__name__, code.co_name) if owner is not None else code.co_name
+                if os.path.abspath(code.co_filename).startswith(os.path.splitext(os.path.abspath(__file__))[0]):
+                    return name
+                fallback = fallback or name
+            frame = frame.f_back
+        return fallback or '?'
+
+    @staticmethod
+    def summary(calls):
+        """Per caller rows, most time spent first."""
+        rows = {}
+        for call in calls:
+            row = rows.setdefault(call['caller'], {'caller': call['caller'], 'calls': 0, 'total': 0.0,
+                                                   'max': 0.0, 'sent': 0, 'received': 0})
+            row['calls'] += 1
+            row['total'] += call['duration']
+            row['max'] = max(row['max'], call['duration'])
+            row['sent'] += call['sent']
+            row['received'] += call['received']
+        for row in rows.values():
+            row['mean'] = row['total'] / row['calls']
+        return sorted(rows.values(), key=lambda row: row['total'], reverse=True)
+
+    @staticmethod
+    def chrome_trace(calls):
+        """Calls in the Chrome trace event format (chrome://tracing, Perfetto)."""
+        origin = min(call['start'] for call in calls) if calls else 0
+        events = [{'name': call['caller'], 'cat': call['command'], 'ph': 'X', 'pid': 1, 'tid': call['thread'],
+                   'ts': int((call['start'] - origin) * 1000000), 'dur': int(call['duration'] * 1000),
+                   'args': {'sent': call['sent'], 'received': call['received']}}
+                  for call in calls]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+profiler = CallProfiler()
+
+
+class AtomRegistry(object):
+    """Imports each atom into a marionette context once, the first time a script uses it.
+
+    Imports are remembered per session and context, so creating
+    GaiaApps/GaiaData/GaiaDevice objects costs no round trips. A context
+    changed without the registry knowing is noticed when a script fails
+    because its atoms are not defined there, see AtomLoader.
+    """
+
+    # global a script refers to -> atom defining it
+    ATOMS = (('GaiaApps', 'gaia_apps.js'),
+             ('waitFor', 'gaia_apps.js'),
+             ('GaiaDataLayer', 'gaia_data_layer.js'),
+             ('GaiaLockScreen', 'gaia_lock_screen.js'),
+             ('Accessibility', 'accessibility.js'),
+             ('MozReflowAtom', 'reflow.js'),
+             ('GaiaKeys', 'gaia_keys.js'))
+    # atoms calling helpers of other atoms (waitFor lives in gaia_apps.js)
+    DEPENDENCIES = {'gaia_data_layer.js': ('gaia_apps.js',),
+                    'gaia_lock_screen.js': ('gaia_apps.js',)}
+
+    _sources = {}
+
+    def __init__(self):
+        self._sessions = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def source(cls, name):
+        if name not in cls._sources:
+            with open(os.path.join(ATOMS_PATH, name)) as f:
+                cls._sources[name] = f.read()
+        return cls._sources[name]
+
+    def _state(self, marionette):
+        # a new session (e.g. after restart_b2g) starts without imports, in content
+        session = (getattr(marionette, 'session_id', None), id(getattr(marionette, 'session', None)))
+        state = self._sessions.get(marionette)
+        if state is None or state['session'] != session:
+            state = {'session': session, 'context': marionette.CONTEXT_CONTENT, 'imported': {}}
+            self._sessions[marionette] = state
+        return state
+
+    def context(self, marionette):
+        return self._state(marionette)['context']
+
+    def session_cache(self, marionette):
+        """Dict for data kept as long as the session, dropped with it like the imports."""
+        return self._state(marionette).setdefault('cache', {})
+
+    def set_context(self, marionette, context):
+        self._state(marionette)['context'] = context
+
+    def forget(self, marionette):
+        """Drops what is known about the imports of marionette, they are imported again when needed."""
+        self._state(marionette)['imported'] = {}
+
+    def require(self, marionette, *names):
+        """Imports the atoms (and the ones they depend on) missing from the current context."""
+        state = self._state(marionette)
+        imported = state['imported'].setdefault(state['context'], set())
+        for name in names:
+            if name in imported:
+                continue
+            self.require(marionette, *self.DEPENDENCIES.get(name, ()))
+            profiler.call('importScript', self.source(name), None,
+                          lambda: marionette.import_script(os.path.join(ATOMS_PATH, name)))
+            imported.add(name)
+
+    def atoms_for(self, script):
+        return [name for symbol, name in self.ATOMS if symbol in script]
+
+    def missing(self, error, names):
+        """Whether a script error says one of the atoms names is not defined."""
+        return any('%s is not defined' % symbol in str(error) for symbol, name in self.ATOMS if name in names)
+
+
+atoms = AtomRegistry()
+
+
+class AtomLoader(object):
+    """Marionette wrapper importing the atoms a script refers to right before it runs.
+
+    Everything else is passed through to the wrapped client. Context changes
+    made through the wrapper are followed; after one made on the wrapped
+    client a script may fail because its atoms are missing in that context,
+    it then runs once more after they were imported again.
+    """
+
+    def __init__(self, marionette, registry=atoms):
+        self.__dict__['_marionette'] = marionette
+        self.__dict__['_registry'] = registry
+
+    @classmethod
+    def wrap(cls, marionette):
+        return marionette if isinstance(marionette, cls) else cls(marionette)
+
+    def __getattr__(self, name):
+        return getattr(self._marionette, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._marionette, name, value)
+
+    def set_context(self, context):
+        self._marionette.set_context(context)
+        self._registry.set_context(self._marionette, context)
+
+    @contextmanager
+    def using_context(self, context):
+        previous = self._registry.context(self._marionette)
+        self.set_context(context)
+        try:
+            yield
+        finally:
+            self.set_context(previous)
+
+    def execute_script(self, script, *args, **kwargs):
+        return self._execute('executeScript', self._marionette.execute_script, script, args, kwargs)
+
+    def execute_async_script(self, script, *args, **kwargs):
+        return self._execute('executeAsyncScript', self._marionette.execute_async_script, script, args, kwargs)
+
+    def _execute(self, command, method, script, args, kwargs):
+        names = self._registry.atoms_for(script)
+        self._registry.require(self._marionette, *names)
+        script_args = kwargs.get('script_args', args[0] if args else None)
+        try:
+            return profiler.call(command, script, script_args, lambda: method(script, *args, **kwargs))
+        except JavascriptException as e:
+            if not self._registry.missing(e, names):
+                raise
+        self._registry.forget(self._marionette)
+        self._registry.require(self._marionette, *names)
+        return profiler.call(command, script, script_args, lambda: method(script, *args, **kwargs))
+
+
+def write_data_url(path, data_url, chunk_size=SCREENSHOT_CHUNK_SIZE):
+    """Decodes a base64 data url into path a chunk at a time, returns the bytes written."""
+    offset = data_url.find(',') + 1
+    written = 0
+    with open(path, 'wb') as f:
+        for chunk_start in xrange(offset, len(data_url), chunk_size):
+            data = base64.b64decode(data_url[chunk_start:chunk_start + chunk_size])
+            f.write(data)
+            written += len(data)
+    return written
 
 class GaiaApp(object):
 
@@ -24,9 +327,49 @@ class GaiaApp(object):
 class GaiaApps(object):
 
     def __init__(self, marionette):
-        self.marionette = marionette
-        js = os.path.abspath(os.path.join(__file__, os.path.pardir, 'atoms', "gaia_apps.js"))
-        self.marionette.import_script(js)
+        self.marionette = AtomLoader.wrap(marionette)
+
+    @staticmethod
+    def normalize_name(name):
+        # same as GaiaApps.normalizeName in gaia_apps.js
+        return re.sub('[- ]+', '', name).lower()
+
+    @property
+    def app_index(self):
+        """Installed apps and entry points, fetched in one round trip the first time it is used.
+
+        A dict with the device side 'generation' it was built at, the 'apps'
+        in the order the device lists them and 'names' mapping every
+        normalized (and localised) name to the first app using it, the one
+        GaiaApps.locateWithName would pick.
+        """
+        cache = atoms.session_cache(self.marionette._marionette)
+        if 'app_index' not in cache:
+            self.marionette.switch_to_frame()
+            index = self.marionette.execute_script('return GaiaApps.getAppIndex();')
+            index['names'] = {}
+            for app in index['apps']:
+                for name in app['names']:
+                    index['names'].setdefault(name, app)
+            cache['app_index'] = index
+        return cache['app_index']
+
+    def invalidate_app_index(self):
+        """Forgets the app index, launches detect installs/uninstalls and do this themselves."""
+        atoms.session_cache(self.marionette._marionette).pop('app_index', None)
+
+    def _locate(self, name):
+        app = self.app_index['names'].get(self.normalize_name(name))
+        if app is None:
+            # may have been installed since the index was built
+            self.invalidate_app_index()
+            app = self.app_index['names'].get(self.normalize_name(name))
+        return app
+
+    def manifest_url(self, name):
+        """The manifest URL of the installed app called name, None when there is none."""
+        app = self._locate(name)
+        return app and app['manifestURL']
 
     def get_permission(self, app_name, permission_name):
         self.marionette.switch_to_frame()
@@ -50,8 +393,20 @@ class GaiaApps(object):
                                                           % (manifest_url, json.dumps(entry_point)), script_timeout=launch_timeout)
             assert result, "Failed to launch app with manifest_url '%s'" % manifest_url
         else:
-            result = self.marionette.execute_async_script("GaiaApps.launchWithName('%s')" % name, script_timeout=launch_timeout)
-            assert result, "Failed to launch app with name '%s'" % name
+            result = {'stale': True}
+            for attempt in range(2):
+                located = self._locate(name)
+                assert located, "Failed to launch app with name '%s'" % name
+                # apps installed/uninstalled since the index was built make the device refuse
+                result = self.marionette.execute_async_script(
+                    'GaiaApps.launchWithManifestURL(%s, %s, %d)' % (json.dumps(located['manifestURL']),
+                                                                    json.dumps(located['entryPoint']),
+                                                                    self.app_index['generation']),
+                    script_timeout=launch_timeout)
+                if not (result and result.get('stale')):
+                    break
+                self.invalidate_app_index()
+            assert result and not result.get('stale'), "Failed to launch app with name '%s'" % name
         app = GaiaApp(frame=result.get('frame'),
                       src=result.get('src'),
                       name=result.get('name'),
@@ -76,8 +431,12 @@ class GaiaApps(object):
         self.marionette.switch_to_frame(self.displayed_app.frame)
 
     def is_app_installed(self, app_name):
-        self.marionette.switch_to_frame()
-        return self.marionette.execute_async_script("GaiaApps.locateWithName('%s')" % app_name)
+        app = self._locate(app_name)
+        if not app:
+            return False
+        # names starts with the normalized name of the entry point, its app_index key
+        return {'name': app['appName'], 'origin': app['origin'],
+                'entryPoint': app['entryPoint'], 'normalizedName': app['names'][0]}
 
     def kill(self, app):
         self.marionette.switch_to_frame()
@@ -97,21 +456,8 @@ class GaiaApps(object):
 
     @property
     def installed_apps(self):
-        apps = self.marionette.execute_async_script(
-            'return GaiaApps.getInstalledApps();')
-        result = []
-        for app in [a for a in apps if not a['manifest'].get('role')]:
-            entry_points = app['manifest'].get('entry_points')
-            if entry_points:
-                for ep in entry_points.values():
-                    result.append(GaiaApp(
-                        origin=app['origin'],
-                        name=ep['name']))
-            else:
-                result.append(GaiaApp(
-                    origin=app['origin'],
-                    name=app['manifest']['name']))
-        return result
+        return [GaiaApp(origin=app['origin'], name=app['name'])
+                for app in self.app_index['apps'] if not app['role']]
 
     def running_apps(self, include_system_apps=False):
         '''  Returns a list of running apps
@@ -130,20 +476,303 @@ class GaiaApps(object):
         return result
 
 
+def parse_keys(keys, delay=KEY_DELAY, wait_timeout=10):
+    """Turns a key sequence into the steps played by GaiaDevice.press_keys.
+
+    keys is a string or a list of tokens:
+        KEY[*COUNT][@MS]   press KEY COUNT times, MS (default delay) after each,
+                           KEY may be the keypad's * or #, e.g. '**3' or '#@500'
+        sleep:MS           pause
+        wait:SELECTOR      wait up to wait_timeout s for a matching element
+    Keys from SYSTEM_KEY_EVENTS (home, volumeup...) become system events, as
+    do the recorded hardware keys of HARDWARE_KEY_EVENTS (Home, VolumeUp...).
+    """
+    if isinstance(keys, basestring):
+        keys = shlex.split(keys)
+    steps = []
+    for token in keys:
+        if token.startswith('sleep:'):
+            steps.append({'sleep': int(token[6:])})
+        elif token.startswith('wait:'):
+            steps.append({'selector': token[5:], 'timeout': int(wait_timeout * 1000)})
+        else:
+            # a single character key may be * itself
+            match = re.match(r'^([^*@]+|.)(?:\*(\d+))?(?:@(\d+))?$', token)
+            if not match:
+                raise ValueError('invalid key step: %s' % token)
+            key, count, step_delay = match.groups()
+            count = int(count or 1)
+            key = HARDWARE_KEY_EVENTS.get(key, key)
+            if key in SYSTEM_KEY_EVENTS:
+                for i in range(count):
+                    steps.append({'event': key})
+                    if step_delay:
+                        # recorded pause before the next key
+                        steps.append({'sleep': int(step_delay)})
+            else:
+                steps.append({'key': key, 'count': count,
+                              'delay': int(step_delay) if step_delay is not None else delay})
+    return steps
+
+
+def file_digest(path):
+    """Returns the hex sha-256 of a local file, the digest getFileDigests computes on the device."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(FILE_CHUNK_SIZE), ''):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def file_matches(device_digest, path, modified_after=False):
+    """Whether a getFileDigests result is the one of the local file path.
+
+    Files too large to be hashed on the device match on size, and with
+    modified_after only if the device copy was modified after the local file.
+    """
+    if isinstance(device_digest, dict):
+        return (device_digest['size'] == os.path.getsize(path) and
+                (not modified_after or device_digest['lastModified'] >= os.path.getmtime(path) * 1000))
+    return device_digest is not None and device_digest == file_digest(path)
+
+
+def percentile(values, fraction):
+    """Returns the value below which fraction (0-1) of values fall, nearest rank."""
+    ordered = sorted(values)
+    index = int(round(fraction * (len(ordered) - 1)))
+    return ordered[index]
+
+
+class LaunchBenchmark(object):
+    """Times cold and warm launches of apps with GaiaApps.launch.
+
+    cold is a launch after the app was killed, warm a launch of the app
+    running in the background, displayed the time from the start of the cold
+    launch until GaiaApps.getDisplayedApp reports the app. Times are in ms.
+    """
+
+    PHASES = ('cold', 'warm', 'displayed')
+
+    def __init__(self, marionette, device):
+        self.marionette = marionette
+        self.apps = GaiaApps(marionette)
+        self.device = device
+
+    def _kill_if_running(self, name):
+        for app in self.apps.running_apps():
+            if app.name.lower() == name.lower():
+                self.apps.kill(app)
+
+    def run(self, names, iterations=5):
+        """Returns {name: {phase: [ms, ...]}} for every app."""
+        samples = {}
+        for name in names:
+            samples[name] = dict((phase, []) for phase in self.PHASES)
+            self._kill_if_running(name)
+            for i in range(iterations):
+                start = time.time()
+                app = self.apps.launch(name, switch_to_frame=False)
+                samples[name]['cold'].append((time.time() - start) * 1000)
+                Wait(self.marionette).until(lambda m: self.apps.displayed_app.origin == app.origin)
+                samples[name]['displayed'].append((time.time() - start) * 1000)
+
+                self.device.touch_home_button()
+                start = time.time()
+                self.apps.launch(name, switch_to_frame=False)
+                samples[name]['warm'].append((time.time() - start) * 1000)
+
+                self.apps.kill(app)
+        return samples
+
+    @classmethod
+    def summary(cls, samples):
+        """Returns one row (app, phase, min, median, p95, samples) per app and phase."""
+        rows = []
+        for name in sorted(samples):
+            for phase in cls.PHASES:
+                values = samples[name][phase]
+                if values:
+                    rows.append({'app': name, 'phase': phase,
+                                 'min': min(values),
+                                 'median': percentile(values, 0.5),
+                                 'p95': percentile(values, 0.95),
+                                 'samples': len(values)})
+        return rows
+
+
+class SoakTest(object):
+    """Launches, switches between and kills apps over and over, sampling memory at every step.
+
+    Every cycle launches each app in turn (switching away from the previous
+    one), switches back to each of them and kills them all. The samples
+    taken once everything is killed are comparable from cycle to cycle, the
+    trend of their memory over the cycles shows leaks.
+    """
+
+    def __init__(self, marionette, device, data=None):
+        self.marionette = marionette
+        self.apps = GaiaApps(marionette)
+        self.device = device
+        self.data = data or GaiaData(marionette)
+
+    def sample(self, cycle, step, name=None):
+        """Memory in kB: system 'used' (not free, buffers or cache), 'explicit' and 'uss' per process name."""
+        stats = self.data.memory_stats()
+        meminfo = stats['meminfo']
+        uss = {}
+        for process in stats['processes']:
+            if process['uss'] is not None:
+                uss[process['name']] = uss.get(process['name'], 0) + process['uss']
+        return {'cycle': cycle, 'step': step, 'app': name, 'time': time.time(),
+                'used': meminfo.get('MemTotal', 0) - meminfo.get('MemFree', 0) -
+                        meminfo.get('Buffers', 0) - meminfo.get('Cached', 0),
+                'explicit': stats['explicit'],
+                'uss': uss}
+
+    def run(self, names, cycles, progress=None):
+        """Returns the samples of all cycles, calling progress(sample) after every cycle.
+
+        A launch that fails (e.g. the app was killed for lack of memory) is
+        recorded as an 'error' sample and the cycle goes on.
+        """
+        self.apps.kill_all()
+        samples = [self.sample(0, 'killed')]
+        for cycle in range(1, cycles + 1):
+            for step in ('launch', 'switch'):
+                for name in names:
+                    try:
+                        app = self.apps.launch(name, switch_to_frame=False)
+                    except Exception as e:
+                        samples.append(dict(self.sample(cycle, 'error', name), error=str(e)))
+                        continue
+                    # the app process is named after app.name
+                    samples.append(self.sample(cycle, step, app.name))
+            self.apps.kill_all()
+            samples.append(self.sample(cycle, 'killed'))
+            if progress:
+                progress(samples[-1])
+        return samples
+
+    @staticmethod
+    def slope(points):
+        """Least squares slope of (x, y) points."""
+        count = len(points)
+        mean_x = sum(x for x, y in points) / float(count)
+        mean_y = sum(y for x, y in points) / float(count)
+        variance = sum((x - mean_x) ** 2 for x, y in points)
+        if not variance:
+            return 0.0
+        return sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+
+    @classmethod
+    def trend(cls, samples, threshold=SOAK_LEAK_KB_PER_CYCLE):
+        """One row per memory series with its first, last, max and kB per cycle, flagging leaks.
+
+        System used memory, b2g explicit and every process still running are
+        taken once all apps are killed, each app right after it launched.
+        """
+        series = {}
+        for sample in samples:
+            if sample['step'] == 'killed':
+                values = [('system used', sample['used']), ('b2g explicit', sample['explicit'])]
+                values.extend(('%s uss' % name, uss) for name, uss in sample['uss'].items())
+            elif sample['step'] == 'launch':
+                values = [('%s uss at launch' % sample['app'], sample['uss'].get(sample['app'][:15]))]
+            else:
+                continue
+            for name, value in values:
+                if value is not None:
+                    series.setdefault(name, []).append((sample['cycle'], value))
+        rows = []
+        for name, points in sorted(series.items()):
+            slope = cls.slope(points)
+            rows.append({'series': name, 'first': points[0][1], 'last': points[-1][1],
+                         'max': max(value for cycle, value in points), 'samples': len(points),
+                         'slope': slope,
+                         'leak': len(points) > 2 and slope >= threshold and points[-1][1] > points[0][1]})
+        return rows
+
+
+class GaiaPerf(object):
+    """Collects the developer HUD metrics of one app through atoms/reflow.js.
+
+    The HUD sends a developer-hud-update event per reflow and per jank,
+    memory or frame rate update of the app; the atom keeps them with the
+    time they arrived and summarize() groups them into time buckets. The
+    HUD settings start() turns on are set back to their previous values by
+    stop().
+    """
+
+    HUD_SETTINGS = {'devtools.overlay': True,
+                    'hud.reflows': True,
+                    'hud.jank': True,
+                    'hud.appmemory': True,
+                    'hud.framerate': True}
+
+    def __init__(self, marionette, data=None):
+        self.marionette = AtomLoader.wrap(marionette)
+        self.data = data or GaiaData(marionette)
+        self.previous_settings = None
+
+    def start(self, manifest_url):
+        if self.previous_settings is None:
+            # settings never set are left out, they are reset to null by stop()
+            previous = self.data.get_settings(self.HUD_SETTINGS.keys())
+            self.previous_settings = dict((name, previous.get(name)) for name in self.HUD_SETTINGS)
+        self.data.set_settings(self.HUD_SETTINGS)
+        self.marionette.switch_to_frame()
+        # the atom keeps its state in the sandbox, so it must not be replaced
+        self.marionette.execute_script('MozReflowAtom.startTracking(arguments[0]);',
+                                       [manifest_url], new_sandbox=False)
+
+    def stop(self):
+        """Stops tracking; returns the reflow count, the raw samples and the duration in ms."""
+        self.marionette.switch_to_frame()
+        try:
+            return self.marionette.execute_script('return MozReflowAtom.stopTracking();', new_sandbox=False)
+        finally:
+            if self.previous_settings is not None:
+                self.data.set_settings(self.previous_settings)
+                self.previous_settings = None
+
+    def measure(self, manifest_url, duration, bucket=1.0):
+        self.start(manifest_url)
+        try:
+            time.sleep(duration)
+        finally:
+            result = self.stop()
+        return self.summarize(result, bucket)
+
+    @staticmethod
+    def summarize(result, bucket=1.0):
+        """Groups samples into bucket second intervals.
+
+        Every bucket has its start time and, per metric, the number of updates
+        and the sum, max and last of their values.
+        """
+        size = int(bucket * 1000)
+        buckets = [{'start': float(i * size) / 1000, 'metrics': {}}
+                   for i in range(result['duration'] // size + 1)]
+        for sample in result['samples']:
+            metrics = buckets[min(sample['time'] // size, len(buckets) - 1)]['metrics']
+            metric = metrics.setdefault(sample['name'], {'count': 0, 'total': 0, 'max': None, 'last': None})
+            metric['count'] += 1
+            value = sample['value']
+            if isinstance(value, (int, long, float)):
+                metric['total'] += value
+                metric['max'] = value if metric['max'] is None else max(metric['max'], value)
+            metric['last'] = value
+        return {'reflows': result['count'], 'duration': result['duration'], 'buckets': buckets}
+
+
 class GaiaData(object):
 
     def __init__(self, marionette, testvars=None):
         self.apps = GaiaApps(marionette)
-        self.marionette = marionette
+        # TODO Bugs 1043562/1049489 ContactsAPI scripts run from the chrome context, the
+        # loader imports gaia_data_layer.js there as well the first time one runs
+        self.marionette = AtomLoader.wrap(marionette)
         self.testvars = testvars or {}
-        js = os.path.abspath(os.path.join(__file__, os.path.pardir, 'atoms', "gaia_data_layer.js"))
-        self.marionette.import_script(js)
-
-        # TODO Bugs 1043562/1049489 To perform ContactsAPI scripts from the chrome context, we need
-        # to import the js file into chrome context too
-        self.marionette.set_context(self.marionette.CONTEXT_CHROME)
-        self.marionette.import_script(js)
-        self.marionette.set_context(self.marionette.CONTEXT_CONTENT)
 
     def set_time(self, date_number):
         self.marionette.set_context(self.marionette.CONTEXT_CHROME)
@@ -175,6 +804,35 @@ class GaiaData(object):
         assert result, 'Unable to insert contact %s' % contact
         self.marionette.set_context(self.marionette.CONTEXT_CONTENT)
 
+    def insert_contacts(self, contacts, chunk_size=CONTACT_CHUNK_SIZE, concurrency=CONTACT_SAVE_CONCURRENCY):
+        """Inserts contacts chunk_size at a time, keeping concurrency saves in flight on the device.
+
+        contacts may be any iterable of contact objects or of mozContact
+        dicts. Returns {'ids': [...], 'chunks': [{'contacts', 'failed', 'seconds'}, ...]}
+        with a None id for every contact that could not be saved.
+        """
+        contacts = iter(contacts)
+        ids = []
+        chunks = []
+        # TODO Bug 1049489 - In future, simplify executing scripts from the chrome context
+        self.marionette.set_context(self.marionette.CONTEXT_CHROME)
+        try:
+            while True:
+                chunk = [c.create_mozcontact() if hasattr(c, 'create_mozcontact') else c
+                         for c in itertools.islice(contacts, chunk_size)]
+                if not chunk:
+                    break
+                start = time.time()
+                result = self.marionette.execute_async_script(
+                    'return GaiaDataLayer.insertContacts(arguments[0], %d);' % concurrency,
+                    script_args=[chunk], special_powers=True)
+                assert result, 'Unable to insert contacts %d to %d' % (len(ids), len(ids) + len(chunk))
+                ids.extend(result['ids'])
+                chunks.append({'contacts': len(chunk), 'failed': result['failed'], 'seconds': time.time() - start})
+        finally:
+            self.marionette.set_context(self.marionette.CONTEXT_CONTENT)
+        return {'ids': ids, 'chunks': chunks}
+
     def insert_sim_contact(self, contact, contact_type='adn'):
         # TODO Bug 1049489 - In future, simplify executing scripts from the chrome context
         self.marionette.set_context(self.marionette.CONTEXT_CHROME)
@@ -193,13 +851,38 @@ class GaiaData(object):
         assert result, 'Unable to insert SIM contact %s' % moz_contact_id
         self.marionette.set_context(self.marionette.CONTEXT_CONTENT)
 
-    def remove_all_contacts(self):
+    @property
+    def contacts_count(self):
+        # TODO Bug 1049489 - In future, simplify executing scripts from the chrome context
+        self.marionette.set_context(self.marionette.CONTEXT_CHROME)
+        result = self.marionette.execute_async_script('return GaiaDataLayer.getContactsCount();', special_powers=True)
+        self.marionette.set_context(self.marionette.CONTEXT_CONTENT)
+        return result
+
+    def remove_all_contacts(self, concurrency=CONTACT_REMOVAL_CONCURRENCY):
+        """Removes every contact and returns the method used, counts, seconds and removals per second.
+
+        Uses mozContacts.clear() when available, otherwise keeps concurrency
+        removals in flight on the device.
+        """
+        timeout = max(self.marionette.timeout or 60000, 1000 * (self.contacts_count or 0) / concurrency)
+        # TODO Bug 1049489 - In future, simplify executing scripts from the chrome context
+        self.marionette.set_context(self.marionette.CONTEXT_CHROME)
+        result = self.marionette.execute_async_script('return GaiaDataLayer.removeAllContacts(%d);' % concurrency,
+                                                      special_powers=True, script_timeout=timeout)
+        assert result and not result['failed'], 'Unable to remove all contacts'
+        self.marionette.set_context(self.marionette.CONTEXT_CONTENT)
+        return result
+
+    def remove_all_sim_contacts(self, contact_type='adn', concurrency=CONTACT_REMOVAL_CONCURRENCY):
         # TODO Bug 1049489 - In future, simplify executing scripts from the chrome context
         self.marionette.set_context(self.marionette.CONTEXT_CHROME)
-        timeout = max(self.marionette.timeout or 60000, 1000 * len(self.all_contacts))
-        result = self.marionette.execute_async_script('return GaiaDataLayer.removeAllContacts();', special_powers=True, script_timeout=timeout)
-        assert result, 'Unable to remove all contacts'
+        result = self.marionette.execute_async_script('return GaiaDataLayer.removeAllSIMContacts("%s", %d);'
+                                                      % (contact_type, concurrency), special_powers=True,
+                                                      script_timeout=max(self.marionette.timeout or 60000, 300000))
+        assert result and not result['failed'], 'Unable to remove all SIM contacts'
         self.marionette.set_context(self.marionette.CONTEXT_CONTENT)
+        return result
 
     def get_setting(self, name):
         return self.marionette.execute_async_script('return GaiaDataLayer.getSetting("%s")' % name)
@@ -214,6 +897,47 @@ class GaiaData(object):
         result = self.marionette.execute_async_script('return GaiaDataLayer.setSetting("%s", %s)' % (name, value))
         assert result, "Unable to change setting with name '%s' to '%s'" % (name, value)
 
+    def get_settings(self, names):
+        """Returns a dict with the values of all named settings, read in one round trip."""
+        result = self.marionette.execute_async_script('return GaiaDataLayer.getSettings(%s)' % json.dumps(list(names)))
+        assert result is not False, "Unable to read settings %s" % ', '.join(names)
+        return result
+
+    def set_settings(self, settings):
+        """Changes all settings in a single transaction and returns the values read back from it."""
+        result = self.marionette.execute_async_script('return GaiaDataLayer.setSettings(%s)' % json.dumps(settings))
+        assert result is not False, "Unable to change settings %s" % ', '.join(settings)
+        return result
+
+    def snapshot(self, prefs=(), exclude=SNAPSHOT_EXCLUDED_SETTINGS):
+        """Returns all settings, the given Gecko prefs and the known Wi-Fi networks in one round trip.
+
+        Settings starting with any of exclude and blob settings are left out.
+        A pref that is not set is None.
+        """
+        self.marionette.switch_to_frame()
+        snapshot = self.marionette.execute_async_script('return GaiaDataLayer.getSnapshot(arguments[0]);',
+                                                        script_args=[list(prefs)], special_powers=True)
+        assert snapshot, 'Unable to take a snapshot'
+        snapshot['settings'] = dict((name, value) for name, value in snapshot['settings'].items()
+                                    if not name.startswith(tuple(exclude)))
+        return snapshot
+
+    def restore(self, snapshot):
+        """Brings the device back to a snapshot in one round trip, writing only what differs.
+
+        The comparison runs on the device. Known networks missing from the
+        snapshot are forgotten, the ones missing on the device are added when
+        the snapshot has their credentials ('password', 'psk', 'wep' or
+        'identity'). Returns the changed 'settings' and 'prefs', the
+        'forgotten', 'added' and 'missing' networks and 'seconds'.
+        """
+        self.marionette.switch_to_frame()
+        result = self.marionette.execute_async_script('return GaiaDataLayer.applySnapshot(arguments[0]);',
+                                                      script_args=[snapshot], special_powers=True)
+        assert result, 'Unable to restore snapshot'
+        return result
+
     def _get_pref(self, datatype, name):
         self.marionette.switch_to_frame()
         pref = self.marionette.execute_script("return SpecialPowers.get%sPref('%s');" % (datatype, name), special_powers=True)
@@ -250,8 +974,7 @@ class GaiaData(object):
 
     def set_volume(self, value):
         channels = ['alarm', 'content', 'notification']
-        for channel in channels:
-            self.set_setting('audio.volume.%s' % channel, value)
+        self.set_settings(dict(('audio.volume.%s' % channel, value) for channel in channels))
 
     def bluetooth_enable(self):
         self.marionette.switch_to_frame()
@@ -354,13 +1077,257 @@ class GaiaData(object):
         result.extend(self.video_files)
         return result
 
+    def files_page(self, storage_type, token=None, page_size=FILES_PAGE_SIZE, extensions=None,
+                   min_size=None, max_size=None, since=None, before=None, prefix=None):
+        """Returns one page of files as {'files': [...], 'token': ...}, filtered on the device.
+
+        Pass the token back to get the next page, it is None after the last
+        one. The device keeps the enumeration of a token open until its last
+        page, a minute without use or GaiaDataLayer.closeFilesPage(token).
+        since and before compare the last modified time in ms since the
+        epoch, prefix limits the enumeration to a directory of the storage.
+        """
+        file_filter = {'extensions': extensions, 'minSize': min_size, 'maxSize': max_size,
+                       'since': since, 'before': before, 'prefix': prefix}
+        page = self.marionette.execute_async_script(
+            'return GaiaDataLayer.getFilesPage(arguments[0], arguments[1], arguments[2], arguments[3]);',
+            script_args=[storage_type, dict((k, v) for k, v in file_filter.items() if v), page_size, token])
+        assert page, 'Unable to enumerate %s' % storage_type
+        return page
+
+    def iter_files(self, storage_type, page_size=FILES_PAGE_SIZE, **filters):
+        """Yields every file of storage_type matching the files_page filters."""
+        token = None
+        try:
+            while True:
+                page = self.files_page(storage_type, token, page_size, **filters)
+                token = page['token']
+                for f in page['files']:
+                    yield f
+                if token is None:
+                    return
+        finally:
+            if token is not None:
+                # left before the end, the device would keep the enumeration open
+                self.marionette.execute_script('GaiaDataLayer.closeFilesPage(arguments[0]);', [token])
+
+    def _verify_files(self, storage_type, local_paths):
+        """Asserts the device files (keys) have the sha-256 (size when large) of the local files (values)."""
+        digests = self.marionette.execute_async_script(
+            'return GaiaDataLayer.getFileDigests(arguments[0], arguments[1], arguments[2]);',
+            script_args=[storage_type, local_paths.keys(), FILE_DIGEST_MAX_SIZE])
+        for path, local_path in local_paths.items():
+            assert file_matches(digests.get(path), local_path), \
+                'Checksum mismatch between %s and %s:%s' % (local_path, storage_type, path)
+
+    def push_file(self, local_path, storage_type, path, chunk_size=FILE_CHUNK_SIZE):
+        return self.push_files([(local_path, path)], storage_type, chunk_size)
+
+    def push_files(self, files, storage_type, chunk_size=FILE_CHUNK_SIZE, transfers=FILE_TRANSFERS):
+        """Copies (local_path, path) pairs to device storage in base64 chunks appended on the device.
+
+        Every round trip carries the next chunk of up to transfers files, and
+        each file's sha-256 is checked at the end. Returns the number of files,
+        bytes, round trips and seconds.
+        """
+        start = time.time()
+        if not files:
+            return {'files': 0, 'bytes': 0, 'round_trips': 0, 'seconds': 0}
+        pending = list(files)
+        active = []
+        sent = 0
+        round_trips = 0
+        try:
+            while pending or active:
+                while pending and len(active) < transfers:
+                    local_path, path = pending.pop(0)
+                    active.append({'file': open(local_path, 'rb'), 'path': path, 'offset': 0})
+                chunks = []
+                for transfer in list(active):
+                    data = transfer['file'].read(chunk_size)
+                    chunks.append({'name': transfer['path'], 'data': base64.b64encode(data),
+                                   'append': transfer['offset'] > 0})
+                    transfer['offset'] += len(data)
+                    sent += len(data)
+                    if len(data) < chunk_size:
+                        transfer['file'].close()
+                        active.remove(transfer)
+                result = self.marionette.execute_async_script(
+                    'return GaiaDataLayer.writeFileChunks(arguments[0], arguments[1]);',
+                    script_args=[storage_type, chunks])
+                round_trips += 1
+                assert result, 'Unable to write %s to %s' % (', '.join(c['name'] for c in chunks), storage_type)
+        finally:
+            # files still being sent when a round trip failed
+            for transfer in active:
+                transfer['file'].close()
+
+        self._verify_files(storage_type, dict((path, local_path) for local_path, path in files))
+        return {'files': len(files), 'bytes': sent, 'round_trips': round_trips, 'seconds': time.time() - start}
+
+    def pull_file(self, storage_type, path, local_path, chunk_size=FILE_CHUNK_SIZE):
+        return self.pull_files([(path, local_path)], storage_type, chunk_size)
+
+    def pull_files(self, files, storage_type, chunk_size=FILE_CHUNK_SIZE, transfers=FILE_TRANSFERS):
+        """Copies (path, local_path) pairs from device storage, reading the next chunk
+        of up to transfers files per round trip, and checks their sha-256.
+        """
+        start = time.time()
+        pending = list(files)
+        active = []
+        received = 0
+        round_trips = 0
+        try:
+            while pending or active:
+                while pending and len(active) < transfers:
+                    path, local_path = pending.pop(0)
+                    active.append({'file': open(local_path, 'wb'), 'path': path, 'offset': 0})
+                requests = [{'name': t['path'], 'offset': t['offset'], 'length': chunk_size} for t in active]
+                chunks = self.marionette.execute_async_script(
+                    'return GaiaDataLayer.readFileChunks(arguments[0], arguments[1]);',
+                    script_args=[storage_type, requests])
+                round_trips += 1
+                for transfer, chunk in zip(list(active), chunks):
+                    assert chunk, 'Unable to read %s:%s' % (storage_type, transfer['path'])
+                    data = base64.b64decode(chunk['data'])
+                    transfer['file'].write(data)
+                    transfer['offset'] += len(data)
+                    received += len(data)
+                    if transfer['offset'] >= chunk['size']:
+                        transfer['file'].close()
+                        active.remove(transfer)
+        finally:
+            # files still being received when a round trip failed
+            for transfer in active:
+                transfer['file'].close()
+
+        self._verify_files(storage_type, dict((path, local_path) for path, local_path in files))
+        return {'files': len(files), 'bytes': received, 'round_trips': round_trips, 'seconds': time.time() - start}
+
+    def sync_dir(self, local_dir, storage_type, path, chunk_size=FILE_CHUNK_SIZE):
+        """Pushes the files of local_dir below path, skipping the ones already identical on the device.
+
+        Files are compared by size first and by sha-256 only when the sizes
+        match, files over FILE_DIGEST_MAX_SIZE by modification time. Returns
+        the push_files result plus the pushed and skipped paths.
+        """
+        files = {}
+        for root, dirs, names in os.walk(local_dir):
+            for name in names:
+                local_path = os.path.join(root, name)
+                parts = [p for p in path.split('/') if p] + os.path.relpath(local_path, local_dir).split(os.sep)
+                files['/'.join(parts)] = local_path
+
+        # enumerated names are fully qualified (/sdcard/...), match them on their ending
+        device_sizes = {}
+        for f in self.iter_files(storage_type, prefix=path or None):
+            parts = [p for p in f['name'].split('/') if p]
+            for i in range(len(parts)):
+                device_path = '/'.join(parts[i:])
+                if device_path in files:
+                    device_sizes[device_path] = f['size']
+                    break
+
+        candidates = [p for p, size in device_sizes.items() if size == os.path.getsize(files[p])]
+        digests = {}
+        if candidates:
+            digests = self.marionette.execute_async_script(
+                'return GaiaDataLayer.getFileDigests(arguments[0], arguments[1], arguments[2]);',
+                script_args=[storage_type, candidates, FILE_DIGEST_MAX_SIZE])
+        skipped = sorted(p for p in candidates if file_matches(digests.get(p), files[p], modified_after=True))
+        pushed = sorted(p for p in files if p not in skipped)
+
+        result = self.push_files([(files[p], p) for p in pushed], storage_type, chunk_size)
+        result.update({'pushed': pushed, 'skipped': skipped})
+        return result
+
+    def storage_summary(self, storage_types=MEDIA_STORAGE_TYPES + ('sdcard',)):
+        """Returns {storage_type: {'count', 'bytes'}} for all types in a single round trip."""
+        return self.marionette.execute_async_script(
+            'return GaiaDataLayer.getStorageSummary(arguments[0]);', script_args=[list(storage_types)])
+
+    def memory_stats(self):
+        """Returns the device memory in kB in one round trip.
+
+        'meminfo' has the /proc/meminfo fields, 'processes' the 'pid', 'ppid',
+        'name', 'rss' and 'uss' (the Private_* lines of smaps) memory of b2g and
+        its children, which are named after their app (15 characters at most),
+        None for a process gone while it was read, 'explicit' the heap
+        allocations of b2g or None. Raises when /proc/meminfo could not be
+        read rather than reporting no memory in use.
+        """
+        self.marionette.set_context(self.marionette.CONTEXT_CHROME)
+        try:
+            stats = self.marionette.execute_script('return GaiaDataLayer.getMemoryStats();')
+        finally:
+            self.marionette.set_context(self.marionette.CONTEXT_CONTENT)
+        if not stats['meminfo'].get('MemTotal') or 'MemFree' not in stats['meminfo']:
+            raise Exception('Unable to read /proc/meminfo on the device')
+        return stats
+
     def delete_all_sms(self):
         self.marionette.switch_to_frame()
         return self.marionette.execute_async_script("return GaiaDataLayer.deleteAllSms();", special_powers=True)
 
-    def get_all_sms(self):
-        self.marionette.switch_to_frame()
-        return self.marionette.execute_async_script("return GaiaDataLayer.getAllSms();", special_powers=True)
+    def iter_sms(self, fields=SMS_FIELDS, page_size=SMS_PAGE_SIZE):
+        """Yields every message as a dict of the given fields, fetching page_size per round trip."""
+        token = None
+        while True:
+            self.marionette.switch_to_frame()
+            page = self.marionette.execute_async_script(
+                "return GaiaDataLayer.getSmsPage(arguments[0], arguments[1], arguments[2]);",
+                script_args=[list(fields), page_size, token], special_powers=True)
+            assert page, 'Unable to read sms messages'
+            for message in page['messages']:
+                yield message
+            token = page['token']
+            if token is None:
+                return
+
+    def get_all_sms(self, fields=SMS_FIELDS, page_size=SMS_PAGE_SIZE):
+        return list(self.iter_sms(fields, page_size))
+
+    def insert_sms(self, messages, chunk_size=SMS_CHUNK_SIZE, concurrency=SMS_STORE_CONCURRENCY):
+        """Stores received messages ({'sender', 'body', 'timestamp' in ms}) in the message database.
+
+        No radio is involved, messages from one sender end up in one thread.
+        Returns {'ids': [...], 'chunks': [{'messages', 'failed', 'seconds'}, ...]}.
+        """
+        messages = iter(messages)
+        ids = []
+        chunks = []
+        self.marionette.set_context(self.marionette.CONTEXT_CHROME)
+        try:
+            while True:
+                chunk = list(itertools.islice(messages, chunk_size))
+                if not chunk:
+                    break
+                start = time.time()
+                result = self.marionette.execute_async_script(
+                    'return GaiaDataLayer.insertSms(arguments[0], %d);' % concurrency,
+                    script_args=[chunk], special_powers=True)
+                assert result, 'Unable to store sms %d to %d' % (len(ids), len(ids) + len(chunk))
+                ids.extend(result['ids'])
+                chunks.append({'messages': len(chunk), 'failed': result['failed'], 'seconds': time.time() - start})
+        finally:
+            self.marionette.set_context(self.marionette.CONTEXT_CONTENT)
+        return {'ids': ids, 'chunks': chunks}
+
+    def seed_sms_threads(self, threads, messages_per_thread, first_number=5550000, body='Message %d'):
+        """Fills the Messages app with threads conversations of messages_per_thread each.
+
+        Thread n comes from the number first_number + n, messages are spaced a
+        minute apart ending now. Returns the insert_sms result.
+        """
+        now = int(time.time() * 1000)
+        total = threads * messages_per_thread
+
+        def messages():
+            for i in xrange(total):
+                yield {'sender': str(first_number + i % threads),
+                       'body': body % i,
+                       'timestamp': now - (total - i) * 60000}
+        return self.insert_sms(messages())
 
     def delete_all_call_log_entries(self):
         """The call log needs to be open and focused in order for this to work."""
@@ -389,25 +1356,18 @@ class GaiaData(object):
 
     @property
     def music_files(self):
-        return self.marionette.execute_async_script(
-            'return GaiaDataLayer.getAllMusic();')
+        return list(self.iter_files('music'))
 
     @property
     def picture_files(self):
-        return self.marionette.execute_async_script(
-            'return GaiaDataLayer.getAllPictures();')
+        return list(self.iter_files('pictures'))
 
     @property
     def video_files(self):
-        return self.marionette.execute_async_script(
-            'return GaiaDataLayer.getAllVideos();')
+        return list(self.iter_files('videos'))
 
     def sdcard_files(self, extension=''):
-        files = self.marionette.execute_async_script(
-            'return GaiaDataLayer.getAllSDCardFiles();')
-        if len(extension):
-            return [file for file in files if file['name'].endswith(extension)]
-        return files
+        return list(self.iter_files('sdcard', extensions=[extension] if extension else None))
 
     def send_sms(self, number, message):
         self.marionette.switch_to_frame()
@@ -432,10 +1392,7 @@ class GaiaData(object):
 class Accessibility(object):
 
     def __init__(self, marionette):
-        self.marionette = marionette
-        js = os.path.abspath(os.path.join(__file__, os.path.pardir,
-                                          'atoms', "accessibility.js"))
-        self.marionette.import_script(js)
+        self.marionette = AtomLoader.wrap(marionette)
 
     def is_hidden(self, element):
         return self._run_async_script('isHidden', [element])
@@ -459,14 +1416,26 @@ class Accessibility(object):
     def get_role(self, element):
         return self._run_async_script('getRole', [element])
 
+    def describe(self, elements=None, selector=None, timeout=ACCESSIBILITY_TIMEOUT):
+        """Name, role and states of many elements, or of all matching the css selector, in one round trip.
+
+        Returns a dict per element, in order: 'name', 'role', 'states' (the
+        state names), 'hidden', 'visible' and 'disabled' as the single
+        element calls report them and, for a selector, the 'element'. The
+        accessibles of all elements are waited for together for at most
+        timeout s, 'accessible' is False for those that still have none.
+        """
+        return self._run_async_script('describe', [elements, selector, int(timeout * 1000)],
+                                      script_timeout=int(timeout * 1000) + 10000) or []
+
     def dispatchEvent(self):
         self.marionette.execute_script("window.wrappedJSObject.dispatchEvent(new CustomEvent(" +
                                        "'accessibility-action'));")
 
-    def _run_async_script(self, func, args):
+    def _run_async_script(self, func, args, **kwargs):
         result = self.marionette.execute_async_script(
             'return Accessibility.%s.apply(Accessibility, arguments)' % func,
-            args, special_powers=True)
+            args, special_powers=True, **kwargs)
 
         if not result:
             return
@@ -478,12 +1447,86 @@ class Accessibility(object):
         return result.get('result', None)
 
 
+class ScreenRecorder(object):
+    """Captures screenshots in a loop at up to a given frame rate.
+
+    Frames identical to the previous one are skipped by hash and the decoding
+    and writing of the others happens on a background thread, so the capture
+    loop only waits on the device.
+    """
+
+    def __init__(self, device, out_dir, format='jpeg', quality=None, region=None, scale=None):
+        self.device = device
+        self.out_dir = out_dir
+        self.format = format
+        self.quality = quality
+        self.region = region
+        self.scale = scale
+        self.frames = []
+
+    def _write_frames(self, queue):
+        while True:
+            frame = queue.get()
+            if frame is None:
+                return
+            path, data_url = frame
+            write_data_url(path, data_url)
+
+    def record(self, fps, duration):
+        """Records for duration seconds and returns the frame counts and achieved fps.
+
+        A frames.json index with every written frame's file and capture time is
+        saved next to the frames.
+        """
+        if not os.path.isdir(self.out_dir):
+            os.makedirs(self.out_dir)
+        extension = SCREENSHOT_EXTENSIONS.get(self.format, '.png')
+        queue = Queue.Queue()
+        writer = threading.Thread(target=self._write_frames, args=(queue,))
+        writer.start()
+
+        interval = 1.0 / fps
+        self.frames = []
+        captured = 0
+        previous = None
+        start = time.time()
+        try:
+            while time.time() - start < duration:
+                frame_start = time.time()
+                data_url = self.device.takeScreenshot(self.format, self.quality, self.region,
+                                                      self.scale, reuse_canvas=True)
+                captured += 1
+                digest = hashlib.md5(data_url).digest()
+                if digest != previous:
+                    previous = digest
+                    path = os.path.join(self.out_dir, 'frame_%05d%s' % (captured, extension))
+                    self.frames.append({'file': os.path.basename(path), 'time': frame_start - start})
+                    queue.put((path, data_url))
+                delay = interval - (time.time() - frame_start)
+                if delay > 0:
+                    time.sleep(delay)
+        finally:
+            elapsed = time.time() - start
+            queue.put(None)
+            writer.join()
+
+        with open(os.path.join(self.out_dir, 'frames.json'), 'w') as f:
+            json.dump(self.frames, f, indent=2)
+        return {'captured': captured,
+                'written': len(self.frames),
+                'skipped': captured - len(self.frames),
+                'seconds': elapsed,
+                'fps': captured / elapsed if elapsed else 0}
+
+
 class GaiaDevice(object):
 
     def __init__(self, marionette, testvars=None, manager=None):
         self.manager = manager
-        self.marionette = marionette
+        self.marionette = AtomLoader.wrap(marionette)
         self.testvars = testvars or {}
+        # seconds per phase of the last start_b2g/restart_b2g
+        self.boot_times = None
 
         if self.is_desktop_b2g:
             # Use a temporary directory for storage
@@ -493,9 +1536,6 @@ class GaiaDevice(object):
             # Use the device root for storage
             self.storage_path = self.manager.deviceRoot
 
-        self.lockscreen_atom = os.path.abspath(
-            os.path.join(__file__, os.path.pardir, 'atoms', "gaia_lock_screen.js"))
-
     def _set_storage_path(self):
         if self.is_desktop_b2g:
             # Override the storage location for desktop B2G. This will only
@@ -538,11 +1578,20 @@ class GaiaDevice(object):
         return self._has_wifi
 
     def restart_b2g(self):
-        self.stop_b2g()
-        time.sleep(2)
-        self.start_b2g()
+        """Restarts B2G, returns how long each phase took, see start_b2g."""
+        times = {'stop': self.stop_b2g()}
+        times.update(self.start_b2g())
+        self.boot_times = times
+        return times
 
     def start_b2g(self, timeout=120):
+        """Starts B2G and waits until it is ready, within timeout s in total.
+
+        Returns (and keeps in boot_times) the seconds each phase took: 'port'
+        until marionette answers, 'session' to start the session,
+        'homescreen' until it loaded and 'logo' until the boot logo is hidden.
+        """
+        deadline = time.time() + timeout
         if self.marionette.instance:
             # launch the gecko instance attached to marionette
             self.marionette.instance.start()
@@ -550,39 +1599,68 @@ class GaiaDevice(object):
             self.manager.shellCheckOutput(['start', 'b2g'])
         else:
             raise Exception('Unable to start B2G')
-        self.marionette.wait_for_port()
+        times = {'port': self.wait_for_port(timeout)}
+        start = time.time()
         self.marionette.start_session()
+        times['session'] = time.time() - start
 
-        self.wait_for_b2g_ready(timeout)
+        times.update(self.wait_for_b2g_ready(max(deadline - time.time(), 1)))
 
         # Reset the storage path for desktop B2G
         self._set_storage_path()
+        self.boot_times = times
+        return times
+
+    def wait_for_port(self, timeout=60):
+        """Waits for the marionette server to greet, retrying with backoff; returns the seconds waited.
+
+        A forwarded adb port accepts connections before marionette listens,
+        so only the server's hello counts.
+        """
+        start = time.time()
+        delay = 0.05
+        while True:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(1)
+            try:
+                sock.connect((self.marionette.host, self.marionette.port))
+                if sock.recv(16):
+                    return time.time() - start
+            except socket.error:
+                pass
+            finally:
+                sock.close()
+            if time.time() - start + delay > timeout:
+                raise TimeoutException('marionette did not answer on port %d within %d s' %
+                                       (self.marionette.port, timeout))
+            time.sleep(delay)
+            delay = min(delay * 2, 1)
 
     def wait_for_b2g_ready(self, timeout=120):
-        # Wait for the homescreen to finish loading
-        Wait(self.marionette, timeout).until(expected.element_present(
-            By.CSS_SELECTOR, '#homescreen[loading-state=false]'))
+        """Waits in one script for the homescreen to load and the boot logo to hide.
 
-        # Wait for logo to be hidden
-        self.marionette.set_search_timeout(0)
-        try:
-            Wait(self.marionette, timeout, ignored_exceptions=StaleElementException).until(
-                lambda m: not m.find_element(By.ID, 'os-logo').is_displayed())
-        except NoSuchElementException:
-            pass
-        self.marionette.set_search_timeout(self.marionette.timeout or 10000)
+        Returns the seconds until each, 'homescreen' and 'logo'.
+        """
+        self.marionette.switch_to_frame()
+        times = self.marionette.execute_async_script('GaiaApps.waitForSystemReady();',
+                                                     script_timeout=int(timeout * 1000))
+        return {'homescreen': times['homescreen'] / 1000.0,
+                'logo': (times['logo'] - times['homescreen']) / 1000.0}
 
     @property
     def is_b2g_running(self):
         return 'b2g' in self.manager.shellCheckOutput(['toolbox', 'ps'])
 
     def stop_b2g(self, timeout=5):
+        """Stops B2G, returns the seconds until its process was gone."""
+        start = time.time()
         if self.marionette.instance:
-            # close the gecko instance attached to marionette
+            # close the gecko instance attached to marionette, returns once it exited
             self.marionette.instance.close()
         elif self.is_android_build:
             self.manager.shellCheckOutput(['stop', 'b2g'])
-            Wait(self.marionette, timeout=timeout).until(
+            # toolbox ps is parsed here, older toolbox builds have no grep and only whole second sleeps
+            Wait(self.marionette, timeout=timeout, interval=0.1).until(
                 lambda m: not self.is_b2g_running,
                 message='b2g failed to stop.')
         else:
@@ -590,6 +1668,7 @@ class GaiaDevice(object):
         self.marionette.client.close()
         self.marionette.session = None
         self.marionette.window = None
+        return time.time() - start
 
     def press_sleep_button(self):
         self.marionette.execute_script("""
@@ -598,26 +1677,60 @@ class GaiaDevice(object):
             }));""")
             
     def press_button(self, keyname): #goof
-        env_predict = 'home/volumeup/volumedown/holdstar/holdhash';
-        key_name_list = 'SoftLeft/SoftRight/Enter/ArrowLeft/ArrowRight/ArrowUp/ArrowDown/'
-        if(env_predict.find(keyname)>=0):
-            print "send event %s" % (keyname)
-            cmd = "window.wrappedJSObject.dispatchEvent(new Event('%s'));" % (keyname)
-            self.marionette.switch_to_frame()
-            self.marionette.execute_script(cmd)#home/volumeup/volumedown/holdstar/holdhash can work.
-        else:
-            cmd = """
-                window.wrappedJSObject.dispatchEvent(new KeyboardEvent('keydown', {
-                  key: '""" + keyname + """'
-                }));"""
-            self.marionette.execute_script(cmd)
-            cmd = """
-                window.wrappedJSObject.dispatchEvent(new KeyboardEvent('keyup', {
-                  key: '""" + keyname + """'
-                }));"""
-            self.marionette.execute_script(cmd)
-        
-        
+        # SoftLeft/SoftRight/Enter/ArrowLeft/ArrowRight/ArrowUp/ArrowDown... as key presses,
+        # home/volumeup/volumedown/holdstar/holdhash (or Home/VolumeUp/VolumeDown) as events of the system app
+        self.press_keys([keyname], delay=0)
+
+    def press_keys(self, keys, delay=KEY_DELAY, wait_timeout=10):
+        """Plays a key sequence (see parse_keys) with one round trip per run of keys.
+
+        Keys go to the current frame. System events are sent from the system
+        frame, keys following them go to the app displayed afterwards.
+        Returns the keys pressed, round trips and seconds taken.
+        """
+        start = time.time()
+        steps = parse_keys(keys, delay, wait_timeout)
+        pressed = round_trips = 0
+        in_system_frame = False
+        for is_event, run in itertools.groupby(steps, lambda step: 'event' in step):
+            run = list(run)
+            if is_event:
+                self.marionette.switch_to_frame()
+                self.marionette.execute_script("""
+                    arguments[0].forEach(function(name) {
+                      window.wrappedJSObject.dispatchEvent(new Event(name));
+                    });""", script_args=[[step['event'] for step in run]])
+                in_system_frame = True
+                pressed += len(run)
+                round_trips += 1
+                continue
+            if in_system_frame:
+                GaiaApps(self.marionette).switch_to_displayed_app()
+                in_system_frame = False
+            duration = sum(step.get('count', 0) * step.get('delay', 0) + step.get('sleep', 0) +
+                           step.get('timeout', 0) for step in run)
+            result = self.marionette.execute_async_script('GaiaKeys.play(arguments[0]);', script_args=[run],
+                                                          script_timeout=duration + 10000)
+            pressed += result['pressed']
+            round_trips += 1
+            if result.get('error'):
+                raise TimeoutException('%s after %d keys' % (result['error'], pressed))
+        return {'pressed': pressed, 'round_trips': round_trips, 'seconds': time.time() - start}
+
+    def record_keys(self, duration):
+        """Records the keys pressed on the device for duration s as press_keys tokens.
+
+        The delay of each token is the time until the next key was pressed.
+        Hardware keys are written as the system events press_button sends
+        for them, a synthetic Home key press would do nothing on replay.
+        """
+        self.marionette.switch_to_frame()
+        keys = self.marionette.execute_async_script('GaiaKeys.record(arguments[0]);',
+                                                    script_args=[int(duration * 1000)],
+                                                    script_timeout=int(duration * 1000) + 10000)
+        delays = [gap for key, gap in keys[1:]] + [KEY_DELAY]
+        return ['%s@%d' % (HARDWARE_KEY_EVENTS.get(key, key), gap) for (key, _), gap in zip(keys, delays)]
+
     def press_release_volume_up_then_down_n_times(self, n_times):
         self.marionette.execute_script("""
             function sendEvent(key, aType) {
@@ -653,7 +1766,7 @@ class GaiaDevice(object):
             apps.switch_to_displayed_app()
         else:
             apps.switch_to_displayed_app()
-            mode = self.marionette.find_element(By.TAG_NAME, 'body').get_attribute('class')
+            mode = self.marionette.find_element(By.TAG_NAME, 'body').get_attribute('class') or ''
             self._dispatch_home_button_event()
             apps.switch_to_displayed_app()
             if 'edit-mode' in mode:
@@ -689,21 +1802,36 @@ class GaiaDevice(object):
         Wait(self.marionette).until(lambda m: m.find_element(By.CSS_SELECTOR, 'div.lockScreenWindow.active'))
 
     def unlock(self):
-        self.marionette.import_script(self.lockscreen_atom)
         self.marionette.switch_to_frame()
         result = self.marionette.execute_async_script('GaiaLockScreen.unlock()')
         assert result, 'Unable to unlock screen'
 
-    def takeScreenshot(self):
+    def takeScreenshot(self, format='png', quality=None, region=None, scale=None, reuse_canvas=False):
+        """Returns the screen as a data url.
+
+        format is 'png', 'jpeg' (quality 0-1) or 'raw' for the unencoded RGBA
+        pixels, whose url also carries the width and height. region is an
+        (x, y, width, height) area of the screen, scale shrinks the result.
+        reuse_canvas keeps the canvas on the system window for the next call.
+        """
         with self.marionette.using_context(self.marionette.CONTEXT_CHROME):
             return self.marionette.execute_script("""
-            return (function takeScreenshot() {
-              var canvas = document.createElementNS('http://www.w3.org/1999/xhtml',
+            return (function takeScreenshot(format, quality, region, scale, reuse) {
+              var canvas = (reuse && window.gaiaScreenshotCanvas) ||
+                           document.createElementNS('http://www.w3.org/1999/xhtml',
                                                     'canvas');
-              var width = window.innerWidth;
-              var height = window.innerHeight;
-              canvas.setAttribute('width', width);
-              canvas.setAttribute('height', height);
+              if (reuse) {
+                window.gaiaScreenshotCanvas = canvas;
+              }
+              var x = region ? region[0] : 0;
+              var y = region ? region[1] : 0;
+              var width = region ? region[2] : window.innerWidth;
+              var height = region ? region[3] : window.innerHeight;
+              scale = scale || 1;
+              var canvasWidth = Math.round(width * scale);
+              var canvasHeight = Math.round(height * scale);
+              canvas.setAttribute('width', canvasWidth);
+              canvas.setAttribute('height', canvasHeight);
 
               var context = canvas.getContext('2d');
               var flags =
@@ -711,13 +1839,46 @@ class GaiaDevice(object):
                 context.DRAWWINDOW_DRAW_VIEW |
                 context.DRAWWINDOW_USE_WIDGET_LAYERS;
 
-              context.drawWindow(window, 0, 0, width, height,
+              context.scale(scale, scale);
+              context.drawWindow(window, x, y, width, height,
                                  'rgb(255,255,255)', flags);
 
+              if (format === 'raw') {
+                // skip image encoding on the device, only base64 the pixels
+                var pixels = context.getImageData(0, 0, canvasWidth, canvasHeight).data;
+                var binary = '';
+                for (var i = 0; i < pixels.length; i += 0x8000) {
+                  binary += String.fromCharCode.apply(null, pixels.subarray(i, i + 0x8000));
+                }
+                return 'data:image/x-rgba;width=' + canvasWidth +
+                       ';height=' + canvasHeight + ';base64,' + btoa(binary);
+              }
+              if (format === 'jpeg') {
+                return context.canvas.toDataURL('image/jpeg', quality || 0.92);
+              }
               return context.canvas.toDataURL('image/png');
 
             }.apply(this, arguments));
-            """)
+            """, script_args=[format, quality, region, scale, reuse_canvas])
+
+    def save_screenshot(self, path, format='png', quality=None, region=None, scale=None,
+                        chunk_size=SCREENSHOT_CHUNK_SIZE):
+        """Writes a screenshot to path, decoding the base64 reply a chunk at a time.
+
+        Returns the format, byte count, capture and write times and the peak
+        memory of this process since it started in KB, not of the capture
+        alone (None where it can't be measured).
+        """
+        start = time.time()
+        data_url = self.takeScreenshot(format, quality, region, scale)
+        captured = time.time()
+        written = write_data_url(path, data_url, chunk_size)
+
+        return {'format': data_url[len('data:'):data_url.find(',')].replace(';base64', ''),
+                'bytes': written,
+                'capture_seconds': captured - start,
+                'write_seconds': time.time() - captured,
+                'process_peak_memory_kb': resource and resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
 		
     def change_orientation(self, orientation):
         """  There are 4 orientation states which the phone can be passed in:
@@ -752,3 +1913,95 @@ class GaiaDevice(object):
     @property
     def screen_orientation(self):
         return self.marionette.execute_script('return window.screen.mozOrientation')
+
+
+class DeviceWorker(object):
+    """Runs calls for one marionette client in order on a single thread.
+
+    Calls for one device are serialized, a marionette session answers one
+    command at a time; only calls for different devices run side by side.
+    submit returns a concurrent.futures.Future. Workers are shared by every
+    Queued* object of a client until close() stops them.
+    """
+
+    _workers = weakref.WeakKeyDictionary()
+    _workers_lock = threading.Lock()
+
+    def __init__(self, marionette):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    @classmethod
+    def of(cls, marionette):
+        marionette = getattr(marionette, '_marionette', marionette)
+        with cls._workers_lock:
+            if marionette not in cls._workers:
+                cls._workers[marionette] = cls(marionette)
+            return cls._workers[marionette]
+
+    @classmethod
+    def close(cls, marionette, wait=True):
+        """Stops the worker of marionette once its queued calls ran, a later call starts a new one."""
+        with cls._workers_lock:
+            worker = cls._workers.pop(getattr(marionette, '_marionette', marionette), None)
+        if worker:
+            worker.shutdown(wait)
+
+    def submit(self, function, *args, **kwargs):
+        return self.executor.submit(function, *args, **kwargs)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait)
+
+
+class QueuedGaiaObject(object):
+    """Counterpart of a gaia class whose methods and properties are queued on the device worker.
+
+    They return concurrent.futures.Futures and run one after the other;
+    other attributes of the wrapped object (e.g. GaiaDevice.testvars) are
+    returned as they are. The wrapped object is built on the worker, so
+    constructing this one does not block.
+    """
+
+    gaia_class = None
+
+    def __init__(self, marionette, *args, **kwargs):
+        self.marionette = marionette
+        self._instance = self.worker.submit(self.gaia_class, marionette, *args, **kwargs)
+
+    @property
+    def worker(self):
+        return DeviceWorker.of(self.marionette)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.gaia_class, name, None)
+        if isinstance(attribute, property):
+            return self.worker.submit(lambda: getattr(self._instance.result(), name))
+        if callable(attribute):
+            def call(*args, **kwargs):
+                return self.worker.submit(lambda: getattr(self._instance.result(), name)(*args, **kwargs))
+            return call
+        return getattr(self._instance.result(), name)
+
+    def shutdown(self, wait=True):
+        """Stops the worker of this device, shared with the other Queued* objects of its client."""
+        DeviceWorker.close(self.marionette, wait)
+
+
+class QueuedGaiaApps(QueuedGaiaObject):
+    gaia_class = GaiaApps
+
+
+class QueuedGaiaData(QueuedGaiaObject):
+    gaia_class = GaiaData
+
+
+class QueuedGaiaDevice(QueuedGaiaObject):
+    gaia_class = GaiaDevice
+
+
+def wait_all(futures, timeout=None):
+    """Results of futures in order, waiting at most timeout s in total."""
+    done, pending = wait_for_futures(futures, timeout)
+    if pending:
+        raise TimeoutException('%d calls still running after %s s' % (len(pending), timeout))
+    return [future.result() for future in futures]
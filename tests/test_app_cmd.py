@@ -0,0 +1,118 @@
+"""Runs app_cmd commands against the fake marionette server.
+
+    python -m unittest discover -s tests
+"""
+import functools
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import app_cmd
+import fake_marionette
+
+
+class FakeServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fake_marionette.FakeMarionetteServer(port=0).start()
+        self.session = app_cmd.Session(port=self.server.port, verbose=False)
+
+    def tearDown(self):
+        self.session.close()
+        self.server.stop()
+
+    def execute(self, cmd, name, **options):
+        output, error = app_cmd.execute_captured(self.session, cmd, name, options)
+        self.assertIsNone(error, output)
+        return output
+
+
+class JsonOutputTest(FakeServerTestCase):
+
+    def test_run(self):
+        record = json.loads(self.execute("run", "camera", json=True))
+        self.assertTrue(record['ok'])
+        self.assertEqual(record['exit_code'], app_cmd.EXIT_OK)
+        self.assertEqual(record['result']['name'], "Camera")
+        self.assertIn("launched Camera (%s)" % record['result']['origin'], record['output'])
+
+    def test_failure(self):
+        output, error = app_cmd.execute_captured(self.session, "run", "no-such-app", {'json': True})
+        record = json.loads(output)
+        self.assertFalse(record['ok'])
+        self.assertEqual(record['error'], error)
+        self.assertNotEqual(record['exit_code'], app_cmd.EXIT_OK)
+
+
+class SettingsTest(FakeServerTestCase):
+
+    def test_set_and_get(self):
+        self.execute("setsettings", ["audio.volume.content=7", "lockscreen.enabled=false"])
+        output = self.execute("getsettings", ["audio.volume.content", "lockscreen.enabled"])
+        self.assertEqual(output.splitlines(), ["audio.volume.content=7", "lockscreen.enabled=false"])
+
+    def test_json(self):
+        self.execute("setsettings", ["audio.volume.content=3"])
+        record = json.loads(self.execute("getsettings", ["audio.volume.content"], json=True))
+        self.assertEqual(record['result'], {'audio.volume.content': "3"})
+
+
+class BenchLaunchTest(FakeServerTestCase):
+
+    def test_rows(self):
+        rows = json.loads(self.execute("bench-launch", ["camera", "clock"], iterations=2))
+        self.assertEqual(sorted(set(row['app'] for row in rows)), ["camera", "clock"])
+        for row in rows:
+            self.assertEqual(row['samples'], 2)
+            self.assertLessEqual(row['min'], row['median'])
+
+
+class BatchTest(FakeServerTestCase):
+
+    def setUp(self):
+        super(BatchTest, self).setUp()
+        self.patched = app_cmd.Session, app_cmd.server_available
+        app_cmd.Session = functools.partial(app_cmd.Session, port=self.server.port)
+        app_cmd.server_available = lambda: False
+        handle, self.path = tempfile.mkstemp(suffix=".txt")
+        with os.fdopen(handle, "w") as batch_file:
+            batch_file.write("# launch and tune\n"
+                             "run camera\n"
+                             "\n"
+                             "setsettings audio.volume.content=5\n"
+                             "getsettings audio.volume.content\n"
+                             "run no-such-app\n")
+
+    def tearDown(self):
+        app_cmd.Session, app_cmd.server_available = self.patched
+        os.remove(self.path)
+        super(BatchTest, self).tearDown()
+
+    def batch(self, **options):
+        with app_cmd.captured_output() as output:
+            results = app_cmd.batch(self.path, options)
+        return results, output.getvalue()
+
+    def test_results(self):
+        results, output = self.batch(quiet=True)
+        self.assertEqual([(r['line'], r['cmd']) for r in results],
+                         [(2, "run"), (4, "setsettings"), (5, "getsettings"), (6, "run")])
+        self.assertEqual([bool(r['error']) for r in results], [False, False, False, True])
+        self.assertIn("audio.volume.content=5", results[2]['output'])
+        self.assertIn("failed#### line 6:", output)
+
+    def test_json(self):
+        results, output = self.batch(json=True)
+        records = [json.loads(line) for line in output.splitlines()]
+        self.assertEqual([record.get('command') for record in records[:-1]],
+                         ["run", "setsettings", "getsettings", "run"])
+        self.assertEqual(records[-1]['commands'], 4)
+        self.assertEqual(records[-1]['failed'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()